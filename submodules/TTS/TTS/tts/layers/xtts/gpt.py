@@ -558,16 +558,31 @@ class GPT(nn.Module):
         self.compute_embeddings(cond_latents, text_inputs)
         return self.generate(cond_latents, text_inputs, **hf_generate_kwargs)
 
+    @torch.no_grad()
+    def get_prefix_kv_cache(self, cond_latents):
+        """Run the transformer over the conditioning latents once and return their key/value cache.
+
+        The conditioning latents always come first in the prefix and attention is causal, so the cache only depends
+        on the speaker and can be reused for every text generated with the same `cond_latents`.
+        """
+        out = self.gpt(inputs_embeds=cond_latents, use_cache=True, return_dict=True)
+        past_key_values = out.past_key_values
+        if hasattr(past_key_values, "to_legacy_cache"):
+            past_key_values = past_key_values.to_legacy_cache()
+        return past_key_values
+
     def compute_embeddings(
         self,
         cond_latents,
         text_inputs,
+        prefix_kv_cache=None,
     ):
         text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
         text_inputs = F.pad(text_inputs, (1, 0), value=self.start_text_token)
         emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
         emb = torch.cat([cond_latents, emb], dim=1)
         self.gpt_inference.store_prefix_emb(emb)
+        self.gpt_inference.store_prefix_kv(prefix_kv_cache)
         gpt_inputs = torch.full(
             (
                 emb.shape[0],
@@ -584,9 +599,10 @@ class GPT(nn.Module):
         self,
         cond_latents,
         text_inputs,
+        prefix_kv_cache=None,
         **hf_generate_kwargs,
     ):
-        gpt_inputs = self.compute_embeddings(cond_latents, text_inputs)
+        gpt_inputs = self.compute_embeddings(cond_latents, text_inputs, prefix_kv_cache)
         gen = self.gpt_inference.generate(
             gpt_inputs,
             bos_token_id=self.start_audio_token,
@@ -599,6 +615,71 @@ class GPT(nn.Module):
             return gen.sequences[:, gpt_inputs.shape[1] :], gen
         return gen[:, gpt_inputs.shape[1] :]
 
+    def compute_embeddings_batch(
+        self,
+        cond_latents,
+        text_inputs_list,
+        prefix_kv_cache=None,
+    ):
+        """Build the prefix embeddings for several texts sharing the same conditioning latents.
+
+        Every prefix is ``[cond_latents, padding, start_text, text, stop_text]``. The padding sits between the
+        conditioning latents and the text so that the ``start_audio_token`` of every row is in the last column, which
+        keeps the mel positional embeddings of the generated tokens aligned across the batch, and the conditioning
+        latents stay in the same columns for every row so a shared `prefix_kv_cache` can be used. The returned
+        attention mask hides the padding.
+        """
+        text_embs = []
+        for text_inputs in text_inputs_list:
+            text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
+            text_inputs = F.pad(text_inputs, (1, 0), value=self.start_text_token)
+            text_embs.append(self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs))
+        max_text_len = max(text_emb.shape[1] for text_emb in text_embs)
+        cond_len = cond_latents.shape[1]
+        emb = torch.cat(
+            [torch.cat([cond_latents, F.pad(text_emb, (0, 0, max_text_len - text_emb.shape[1], 0))], dim=1)
+             for text_emb in text_embs],
+            dim=0,
+        )
+        self.gpt_inference.store_prefix_emb(emb)
+        self.gpt_inference.store_prefix_kv(prefix_kv_cache)
+
+        max_len = emb.shape[1]
+        attention_mask = torch.ones((len(text_embs), max_len + 1), dtype=torch.long, device=emb.device)
+        for i, text_emb in enumerate(text_embs):
+            attention_mask[i, cond_len : cond_len + max_text_len - text_emb.shape[1]] = 0
+        gpt_inputs = torch.full(
+            (len(text_embs), max_len + 1),  # +1 for the start_audio_token
+            fill_value=1,
+            dtype=torch.long,
+            device=emb.device,
+        )
+        gpt_inputs[:, -1] = self.start_audio_token
+        return gpt_inputs, attention_mask
+
+    def generate_batch(
+        self,
+        cond_latents,
+        text_inputs_list,
+        prefix_kv_cache=None,
+        **hf_generate_kwargs,
+    ):
+        """Generate audio codes for a list of texts in one batch.
+
+        Rows that emit ``stop_audio_token`` are finished independently and padded with it afterwards.
+        """
+        gpt_inputs, attention_mask = self.compute_embeddings_batch(cond_latents, text_inputs_list, prefix_kv_cache)
+        gen = self.gpt_inference.generate(
+            gpt_inputs,
+            attention_mask=attention_mask,
+            bos_token_id=self.start_audio_token,
+            pad_token_id=self.stop_audio_token,
+            eos_token_id=self.stop_audio_token,
+            max_length=self.max_gen_mel_tokens + gpt_inputs.shape[-1],
+            **hf_generate_kwargs,
+        )
+        return gen[:, gpt_inputs.shape[1] :]
+
     def get_generator(self, fake_inputs, **hf_generate_kwargs):
         return self.gpt_inference.generate_stream(
             fake_inputs,
@@ -17,10 +17,19 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
         self.final_norm = norm
         self.lm_head = nn.Sequential(norm, linear)
         self.kv_cache = kv_cache
+        self.cached_prefix_kv = None
 
     def store_prefix_emb(self, prefix_emb):
         self.cached_prefix_emb = prefix_emb
 
+    def store_prefix_kv(self, prefix_kv):
+        """Store the key/value cache of the conditioning latents that start every prefix, or None to disable it.
+
+        When set, the first forward pass of a generation only runs the transformer over the embeddings that follow
+        the conditioning latents and attends to the stored cache for them.
+        """
+        self.cached_prefix_kv = prefix_kv
+
     def prepare_inputs_for_generation(self, input_ids, past_key_values=None, **kwargs):
         token_type_ids = kwargs.get("token_type_ids", None)  # usually None
         if not self.kv_cache:
@@ -89,6 +98,16 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
             else:
                 prefix_emb = self.cached_prefix_emb.to(gen_emb.dtype)
             emb = torch.cat([prefix_emb, gen_emb], dim=1)
+            if past_key_values is None and self.cached_prefix_kv is not None:
+                # reuse the cached keys/values of the conditioning latents instead of recomputing them
+                cond_len = self.cached_prefix_kv[0][0].shape[2]
+                emb = emb[:, cond_len:]
+                if position_ids is not None:
+                    position_ids = position_ids[:, cond_len:]
+                past_key_values = tuple(
+                    tuple(state.expand(emb.shape[0], -1, -1, -1) for state in layer)
+                    for layer in self.cached_prefix_kv
+                )
         else:
             emb = self.embeddings(input_ids)
             emb = emb + self.pos_embedding.get_fixed_embedding(
@@ -379,6 +379,16 @@ class Xtts(BaseTTS):
 
         return gpt_cond_latents, speaker_embedding
 
+    @torch.inference_mode()
+    def get_prefix_kv_cache(self, gpt_cond_latent):
+        """Precompute the GPT key/value cache of the conditioning latents of one speaker.
+
+        Pass the result as `prefix_kv_cache` to `inference()`, `inference_batch()` or `inference_stream()` together
+        with the same `gpt_cond_latent` so that generation starts from the cache instead of re-running attention over
+        the conditioning prefix for every text.
+        """
+        return self.gpt.get_prefix_kv_cache(gpt_cond_latent.to(self.device))
+
     def synthesize(self, text, config, speaker_wav, language, speaker_id=None, **kwargs):
         """Synthesize speech with the given input text.
 
@@ -516,6 +526,7 @@ class Xtts(BaseTTS):
         num_beams=1,
         speed=1.0,
         enable_text_splitting=False,
+        prefix_kv_cache=None,
         **hf_generate_kwargs,
     ):
         language = language.split("-")[0]  # remove the country code
@@ -541,6 +552,7 @@ class Xtts(BaseTTS):
                 gpt_codes = self.gpt.generate(
                     cond_latents=gpt_cond_latent,
                     text_inputs=text_tokens,
+                    prefix_kv_cache=prefix_kv_cache,
                     input_tokens=None,
                     do_sample=do_sample,
                     top_p=top_p,
@@ -582,6 +594,98 @@ class Xtts(BaseTTS):
             "speaker_embedding": speaker_embedding,
         }
 
+    @torch.inference_mode()
+    def inference_batch(
+        self,
+        texts,
+        language,
+        gpt_cond_latent,
+        speaker_embedding,
+        # GPT inference
+        temperature=0.75,
+        length_penalty=1.0,
+        repetition_penalty=10.0,
+        top_k=50,
+        top_p=0.85,
+        do_sample=True,
+        speed=1.0,
+        prefix_kv_cache=None,
+        **hf_generate_kwargs,
+    ):
+        """Synthesize several texts for the same speaker with one batched GPT generation.
+
+        All texts share `gpt_cond_latent` and `speaker_embedding`. The text tokens are padded and generated together,
+        then the latents of every row are computed and decoded by HiFi-GAN separately. Texts are not split into
+        sentences, so each of them must fit in `gpt_max_text_tokens`. `speed` is either one value for all texts or a
+        list with one value per text.
+
+        Returns:
+            A list with one dictionary per text, in the same format as `inference()`.
+        """
+        language = language.split("-")[0]  # remove the country code
+        speeds = speed if isinstance(speed, (list, tuple)) else [speed] * len(texts)
+        gpt_cond_latent = gpt_cond_latent.to(self.device)
+        speaker_embedding = speaker_embedding.to(self.device)
+
+        text_tokens_list = []
+        for text in texts:
+            sent = text.strip().lower()
+            text_tokens = torch.IntTensor(self.tokenizer.encode(sent, lang=language)).unsqueeze(0).to(self.device)
+            assert (
+                text_tokens.shape[-1] < self.args.gpt_max_text_tokens
+            ), " ❗ XTTS can only generate text with a maximum of 400 tokens."
+            text_tokens_list.append(text_tokens)
+
+        gpt_codes_batch = self.gpt.generate_batch(
+            cond_latents=gpt_cond_latent,
+            text_inputs_list=text_tokens_list,
+            prefix_kv_cache=prefix_kv_cache,
+            do_sample=do_sample,
+            top_p=top_p,
+            top_k=top_k,
+            temperature=temperature,
+            num_return_sequences=1,
+            num_beams=1,
+            length_penalty=length_penalty,
+            repetition_penalty=repetition_penalty,
+            output_attentions=False,
+            **hf_generate_kwargs,
+        )
+
+        outputs = []
+        for text_tokens, gpt_codes, speed in zip(text_tokens_list, gpt_codes_batch, speeds):
+            # keep the codes up to and including the first stop token, the rest is padding
+            stop = (gpt_codes == self.gpt.stop_audio_token).nonzero()
+            if len(stop) > 0:
+                gpt_codes = gpt_codes[: stop[0, 0] + 1]
+            gpt_codes = gpt_codes.unsqueeze(0)
+            expected_output_len = torch.tensor([gpt_codes.shape[-1] * self.gpt.code_stride_len], device=self.device)
+            text_len = torch.tensor([text_tokens.shape[-1]], device=self.device)
+            gpt_latents = self.gpt(
+                text_tokens,
+                text_len,
+                gpt_codes,
+                expected_output_len,
+                cond_latents=gpt_cond_latent,
+                return_attentions=False,
+                return_latent=True,
+            )
+
+            length_scale = 1.0 / max(speed, 0.05)
+            if length_scale != 1.0:
+                gpt_latents = F.interpolate(
+                    gpt_latents.transpose(1, 2), scale_factor=length_scale, mode="linear"
+                ).transpose(1, 2)
+
+            outputs.append(
+                {
+                    "wav": self.hifigan_decoder(gpt_latents, g=speaker_embedding).cpu().squeeze().numpy(),
+                    "gpt_latents": gpt_latents.cpu().numpy(),
+                    "speaker_embedding": speaker_embedding,
+                }
+            )
+        return outputs
+
     def handle_chunks(self, wav_gen, wav_gen_prev, wav_overlap, overlap_len):
         """Handle chunk formatting in streaming mode"""
         wav_chunk = wav_gen[:-overlap_len]
@@ -626,6 +730,7 @@ class Xtts(BaseTTS):
         do_sample=True,
         speed=1.0,
         enable_text_splitting=False,
+        prefix_kv_cache=None,
         **hf_generate_kwargs,
     ):
         language = language.split("-")[0]  # remove the country code
@@ -648,6 +753,7 @@ class Xtts(BaseTTS):
             fake_inputs = self.gpt.compute_embeddings(
                 gpt_cond_latent.to(self.device),
                 text_tokens,
+                prefix_kv_cache,
             )
             gpt_generator = self.gpt.get_generator(
                 fake_inputs=fake_inputs,
@@ -0,0 +1,52 @@
+import unittest
+
+import torch
+
+from TTS.tts.layers.xtts.gpt import GPT
+
+
+class TestXttsGPTBatch(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.gpt = GPT(
+            layers=1,
+            model_dim=32,
+            heads=2,
+            max_text_tokens=16,
+            max_mel_tokens=12,
+            max_prompt_tokens=8,
+            number_text_tokens=64,
+            num_audio_tokens=40,
+            start_audio_token=38,
+            stop_audio_token=39,
+            start_text_token=62,
+        ).eval()
+        self.gpt.init_gpt_for_inference(kv_cache=True)
+        self.cond_latents = torch.randn(1, 4, 32)
+        self.texts = [torch.randint(1, 60, (1, 3)), torch.randint(1, 60, (1, 6))]
+
+    def test_compute_embeddings_batch(self):
+        gpt_inputs, attention_mask = self.gpt.compute_embeddings_batch(self.cond_latents, self.texts)
+        # 4 cond latents + longest text (6) + start/stop text tokens + start_audio_token
+        self.assertEqual(tuple(gpt_inputs.shape), (2, 4 + 8 + 1))
+        self.assertEqual(tuple(attention_mask.shape), tuple(gpt_inputs.shape))
+        self.assertTrue((gpt_inputs[:, -1] == self.gpt.start_audio_token).all())
+        # the shorter text is left-padded by 3 columns right after the conditioning latents
+        self.assertEqual(attention_mask[0, 4:7].sum().item(), 0)
+        self.assertEqual(attention_mask[0].sum().item(), gpt_inputs.shape[1] - 3)
+        self.assertEqual(attention_mask[1].sum().item(), gpt_inputs.shape[1])
+
+    def test_generate_batch(self):
+        with torch.no_grad():
+            codes = self.gpt.generate_batch(self.cond_latents, self.texts, do_sample=False)
+            prefix_kv_cache = self.gpt.get_prefix_kv_cache(self.cond_latents)
+            cached_codes = self.gpt.generate_batch(
+                self.cond_latents, self.texts, prefix_kv_cache=prefix_kv_cache, do_sample=False
+            )
+        self.assertEqual(codes.shape[0], 2)
+        self.assertLessEqual(codes.shape[1], self.gpt.max_gen_mel_tokens)
+        self.assertTrue(torch.equal(codes, cached_codes))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -260,11 +260,12 @@ class FullAutoTab(QWidget):
 
     def update_progress(self, progress, status):
         """更新处理进度"""
-        # 确保进度条与状态信息一致
+        # 确保进度条与状态信息一致；ffmpeg 的实时进度更新很频繁，只在百分比变化时写日志
+        if progress != self.current_progress:
+            self.append_log(f"进度更新: {progress}% - {status}")
         self.current_progress = progress
         self.progress_bar.setValue(progress)
         self.progress_label.setText(status)
-        self.append_log(f"进度更新: {progress}% - {status}")
 
     def process_thread(self):
         """异步处理线程"""
@@ -324,7 +325,9 @@ class FullAutoTab(QWidget):
                 config.get('video_volume', 1.0),
                 config.get('output_resolution', '1080p'),
                 config.get('max_workers', 1),
-                config.get('max_retries', 3)
+                config.get('max_retries', 3),
+                progress_callback=lambda progress, status: self.signals.progress.emit(int(progress), status),
+                audio_first=config.get('audio_first', False)
             )
 
             # 完成处理，设置100%进度
@@ -70,6 +70,10 @@ class SettingsTab(QWidget):
         self.video_count = CustomSlider(1, 100, 1, "下载视频数量", 5)
         self.scroll_layout.addWidget(self.video_count)
 
+        # 先下载音频，视频在后台下载
+        self.audio_first = RadioButtonGroup([True, False], "先下载音频（视频在后台下载）", False)
+        self.scroll_layout.addWidget(self.audio_first)
+
         # 音频处理配置
         self.scroll_layout.addWidget(QLabel("=== 音频处理配置 ==="))
         # 模型
@@ -215,6 +219,7 @@ class SettingsTab(QWidget):
             "video_folder": self.video_folder.text(),
             "resolution": self.resolution.value(),
             "video_count": self.video_count.value(),
+            "audio_first": self.audio_first.value(),
             "model": self.model.value(),
             "device": self.device.value(),
             "shifts": self.shifts.value(),
@@ -255,6 +260,9 @@ class SettingsTab(QWidget):
             # 视频数量
             self.video_count.setValue(config.get("video_count", 5))
 
+            # 先下载音频
+            self._set_radio_button(self.audio_first.buttons, config.get("audio_first", False), False)
+
             # 模型
             model_value = config.get("model", "htdemucs_ft")
             self._set_radio_button(self.model.buttons, model_value, "htdemucs_ft")
@@ -402,6 +410,7 @@ class SettingsTab(QWidget):
                 "video_folder": "videos",
                 "resolution": "1080p",
                 "video_count": 5,
+                "audio_first": False,
                 "model": "htdemucs_ft",
                 "device": "auto",
                 "shifts": 5,
@@ -1,6 +1,8 @@
 import os
+import threading
 from PySide6.QtWidgets import (QWidget, QVBoxLayout, QLabel, QLineEdit,
-                               QScrollArea, QCheckBox, QPushButton, QMessageBox)
+                               QScrollArea, QCheckBox, QPushButton, QMessageBox, QProgressBar)
+from PySide6.QtCore import Signal, QObject
 
 from ui_components import (FloatSlider, CustomSlider, RadioButtonGroup,
                            AudioSelector, VideoPlayer)
@@ -12,6 +14,12 @@ except ImportError:
     pass
 
 
+# 合成在后台线程中运行，通过信号把进度和结果送回界面线程
+class SynthesisSignals(QObject):
+    finished = Signal(str, str)  # 完成信号：状态, 视频路径
+    progress = Signal(int, str)  # 进度信号：百分比, 状态信息
+
+
 class SynthesizeVideoTab(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -33,6 +41,11 @@ class SynthesizeVideoTab(QWidget):
         self.add_subtitles.setChecked(True)
         self.scroll_layout.addWidget(self.add_subtitles)
 
+        # 烧录字幕：不勾选时封装为软字幕，条件允许时直接复制视频流
+        self.burn_subtitles = QCheckBox("烧录字幕（需要重新编码）")
+        self.burn_subtitles.setChecked(True)
+        self.scroll_layout.addWidget(self.burn_subtitles)
+
         # 加速倍数
         self.speed_factor = FloatSlider(0.5, 2, 0.05, "加速倍数", 1.00)
         self.scroll_layout.addWidget(self.speed_factor)
@@ -61,14 +74,32 @@ class SynthesizeVideoTab(QWidget):
         )
         self.scroll_layout.addWidget(self.resolution)
 
+        # HLS：按所选分辨率及以下的常用档位输出 hls/master.m3u8
+        self.hls = QCheckBox("输出 HLS（多分辨率自适应码率）")
+        self.hls.setChecked(False)
+        self.scroll_layout.addWidget(self.hls)
+
         # 执行按钮
         self.run_button = QPushButton("开始合成视频")
         self.run_button.clicked.connect(self.run_synthesis)
         self.scroll_layout.addWidget(self.run_button)
 
+        # 预览：360p 快速渲染，用于正式合成前检查配音时间轴
+        self.preview_range = QLineEdit("")
+        self.preview_range.setPlaceholderText("例如 60-120，留空为全片")
+        self.scroll_layout.addWidget(QLabel("预览时间范围（秒）"))
+        self.scroll_layout.addWidget(self.preview_range)
+        self.preview_button = QPushButton("生成预览")
+        self.preview_button.clicked.connect(self.run_preview)
+        self.scroll_layout.addWidget(self.preview_button)
+
         # 状态显示
         self.status_label = QLabel("准备就绪")
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setValue(0)
         self.scroll_layout.addWidget(QLabel("合成状态:"))
+        self.scroll_layout.addWidget(self.progress_bar)
         self.scroll_layout.addWidget(self.status_label)
 
         # 视频播放器
@@ -80,6 +111,39 @@ class SynthesizeVideoTab(QWidget):
         self.layout.addWidget(self.scroll_area)
         self.setLayout(self.layout)
 
+        self.signals = SynthesisSignals()
+        self.signals.progress.connect(self.update_progress)
+        self.signals.finished.connect(self.synthesis_finished)
+
+    def update_progress(self, progress, status):
+        self.progress_bar.setValue(progress)
+        self.status_label.setText(status)
+
+    def synthesis_finished(self, status, video_path):
+        self.run_button.setEnabled(True)
+        self.preview_button.setEnabled(True)
+        self.status_label.setText(status)
+        if video_path and os.path.exists(video_path):
+            self.video_player.set_video(video_path)
+
+    def start_thread(self, target, failure):
+        """在后台线程里运行 target(progress_callback)，返回 (状态, 视频路径)；出错时状态为 failure 加错误信息"""
+        self.run_button.setEnabled(False)
+        self.preview_button.setEnabled(False)
+        self.progress_bar.setValue(0)
+
+        def progress_callback(progress, status):
+            self.signals.progress.emit(int(progress), status)
+
+        def run():
+            try:
+                status, video_path = target(progress_callback)
+                self.signals.finished.emit(status, video_path or '')
+            except Exception as e:
+                self.signals.finished.emit(f"{failure}: {str(e)}", '')
+
+        threading.Thread(target=run, daemon=True).start()
+
     def run_synthesis(self):
         # 这里应该调用原始的synthesize_all_video_under_folder函数
         # 临时实现，实际应用中需要替换为真实的调用
@@ -88,19 +152,31 @@ class SynthesizeVideoTab(QWidget):
 
         # 实际应用中解除以下注释
 
+        # 控件的值在界面线程里读取，后台线程只做合成
+        args = (self.video_folder.text(), self.add_subtitles.isChecked(), self.speed_factor.value(),
+                self.frame_rate.value(), self.background_music.value(), self.bg_music_volume.value(),
+                self.video_volume.value(), self.resolution.value())
+        burn_subtitles = self.burn_subtitles.isChecked()
+        renditions = None
+        if self.hls.isChecked():
+            height = int(self.resolution.value()[:-1])
+            renditions = [self.resolution.value()] + [r for r in ['1080p', '720p', '480p', '360p'] if int(r[:-1]) < height]
+        self.start_thread(lambda progress_callback: synthesize_all_video_under_folder(
+            *args, burn_subtitles=burn_subtitles, renditions=renditions, hls=renditions is not None,
+            progress_callback=progress_callback), "合成失败")
+
+    def run_preview(self):
+        self.status_label.setText("预览渲染中...")
         try:
-            status, video_path = synthesize_all_video_under_folder(
-                self.video_folder.text(),
-                self.add_subtitles.isChecked(),
-                self.speed_factor.value(),
-                self.frame_rate.value(),
-                self.background_music.value(),
-                self.bg_music_volume.value(),
-                self.video_volume.value(),
-                self.resolution.value()
-            )
-            self.status_label.setText(status)
-            if video_path and os.path.exists(video_path):
-                self.video_player.set_video(video_path)
-        except Exception as e:
-            self.status_label.setText(f"合成失败: {str(e)}")
+            preview_range = None
+            if self.preview_range.text().strip():
+                start, end = self.preview_range.text().strip().split('-')
+                preview_range = (float(start), float(end))
+        except ValueError as e:
+            self.status_label.setText(f"预览失败: {str(e)}")
+            return
+        args = (self.video_folder.text(), self.add_subtitles.isChecked(), self.speed_factor.value(),
+                self.frame_rate.value(), self.background_music.value(), self.bg_music_volume.value(),
+                self.video_volume.value())
+        self.start_thread(lambda progress_callback: synthesize_all_video_under_folder(
+            *args, preview=True, preview_range=preview_range, progress_callback=progress_callback), "预览失败")
@@ -0,0 +1,124 @@
+import json
+import os
+import tempfile
+import unittest
+
+from tools import metadata_cache
+from tools import step005_ingest as ingest_module
+from tools.step005_ingest import content_keys, ingest, record_stage, recorded_params, register
+
+STAGE_PARAMS = {
+    'separation': ['htdemucs_ft', 5],
+    'asr': ['WhisperX', 'large', False, None, None],
+    'translation': ['LLM', '简体中文'],
+    'tts': ['xtts', '中文', 'zh-CN-XiaoxiaoNeural'],
+    'synthesis': [True, 1.0, 30, None, 0.5, 1.0, '1080p', False, None],
+}
+
+
+def write(path, content=b'data'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+class TestIngest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.old_cache_path = metadata_cache.cache_path
+        metadata_cache.cache_path = os.path.join(self.root, 'metadata.sqlite3')
+        metadata_cache.initialized = False
+
+        self.processed = os.path.join(self.root, 'processed')
+        write(os.path.join(self.processed, 'download.mp4'), b'video' * 1000)
+        for name in ['audio.wav', 'audio_vocals.wav', 'audio_instruments.wav', 'SPEAKER/SPEAKER_00.wav',
+                     'audio_tts.wav', 'audio_combined.wav', 'wavs/0000.wav', 'video.mp4', 'subtitles.srt']:
+            write(os.path.join(self.processed, name))
+        for name in ['transcript.json', 'summary.json', 'translation.json']:
+            write(os.path.join(self.processed, name), b'{}')
+        for stage, params in STAGE_PARAMS.items():
+            record_stage(self.processed, stage, params)
+        register(self.processed, STAGE_PARAMS)
+
+    def tearDown(self):
+        metadata_cache.cache_path = self.old_cache_path
+        metadata_cache.initialized = False
+        self.tmp.cleanup()
+
+    def copy_of_processed(self, name):
+        folder = os.path.join(self.root, name)
+        write(os.path.join(folder, 'download.mp4'), b'video' * 1000)
+        return folder
+
+    def test_reuses_all_stages_when_params_match(self):
+        folder = self.copy_of_processed('copy')
+        reused = ingest(folder, STAGE_PARAMS)
+        self.assertEqual(reused, [stage for stage, _ in ingest_module.stage_artifacts])
+        self.assertTrue(os.path.exists(os.path.join(folder, 'video.mp4')))
+        self.assertTrue(os.path.exists(os.path.join(folder, 'wavs', '0000.wav')))
+
+    def test_stops_at_first_stage_with_different_params(self):
+        folder = self.copy_of_processed('copy')
+        params = dict(STAGE_PARAMS, translation=['Google Translate', '简体中文'])
+        reused = ingest(folder, params)
+        self.assertEqual(reused, ['separation', 'asr'])
+        self.assertTrue(os.path.exists(os.path.join(folder, 'transcript.json')))
+        self.assertFalse(os.path.exists(os.path.join(folder, 'translation.json')))
+        self.assertFalse(os.path.exists(os.path.join(folder, 'video.mp4')))
+
+    def test_copied_json_does_not_change_original(self):
+        folder = self.copy_of_processed('copy')
+        ingest(folder, STAGE_PARAMS)
+        write(os.path.join(folder, 'translation.json'), b'[]')
+        with open(os.path.join(self.processed, 'translation.json'), 'rb') as f:
+            self.assertEqual(f.read(), b'{}')
+
+    def test_unknown_content_is_not_reused(self):
+        folder = os.path.join(self.root, 'other')
+        write(os.path.join(folder, 'download.mp4'), b'other' * 1000)
+        self.assertEqual(ingest(folder, STAGE_PARAMS), [])
+
+    def test_reused_stages_are_recorded(self):
+        folder = self.copy_of_processed('copy')
+        params = dict(STAGE_PARAMS, translation=['Google Translate', '简体中文'])
+        ingest(folder, params)
+        self.assertEqual(sorted(recorded_params(folder)), ['asr', 'separation'])
+
+    def test_stale_artifacts_are_not_registered(self):
+        # translation.json 来自之前另一种翻译方法，本次运行没有重新生成，不能以当前参数登记
+        stale = self.copy_of_processed('stale')
+        for name in ['audio.wav', 'audio_vocals.wav', 'audio_instruments.wav', 'SPEAKER/SPEAKER_00.wav', 'transcript.json',
+                     'translation.json']:
+            write(os.path.join(stale, name), b'{}')
+        write(os.path.join(stale, 'download.mp4'), b'stale' * 1000)
+        record_stage(stale, 'separation', STAGE_PARAMS['separation'])
+        record_stage(stale, 'asr', STAGE_PARAMS['asr'])
+        register(stale, STAGE_PARAMS)
+
+        folder = os.path.join(self.root, 'copy')
+        write(os.path.join(folder, 'download.mp4'), b'stale' * 1000)
+        self.assertEqual(ingest(folder, STAGE_PARAMS), ['separation', 'asr'])
+        self.assertFalse(os.path.exists(os.path.join(folder, 'translation.json')))
+
+    def test_existing_artifacts_with_other_params_stop_reuse(self):
+        folder = self.copy_of_processed('copy')
+        write(os.path.join(folder, 'transcript.json'), b'[]')
+        write(os.path.join(folder, 'SPEAKER', 'SPEAKER_00.wav'))
+        self.assertEqual(ingest(folder, STAGE_PARAMS), ['separation'])
+        with open(os.path.join(folder, 'transcript.json'), 'rb') as f:
+            self.assertEqual(f.read(), b'[]')
+
+    def test_info_json_id_matches_different_bytes(self):
+        info = {'id': 'abc', 'extractor_key': 'Youtube'}
+        write(os.path.join(self.processed, 'download.info.json'), json.dumps(info).encode())
+        register(self.processed, STAGE_PARAMS)
+        folder = os.path.join(self.root, 'redownload')
+        write(os.path.join(folder, 'download.info.json'), json.dumps(info).encode())
+        write(os.path.join(folder, 'download_audio.m4a'), b'remuxed audio')
+        self.assertEqual(content_keys(folder)[0], 'id:Youtube:abc')
+        self.assertIn('synthesis', ingest(folder, STAGE_PARAMS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from tools import step050_synthesize_video as synthesize
+
+
+class TestSynthesizeRenditions(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name
+        for name, content in [('translation.json', '[]'), ('audio_combined.wav', ''), ('download.mp4', '')]:
+            with open(os.path.join(self.folder, name), 'w', encoding='utf-8') as f:
+                f.write(content)
+        self.commands = []
+        for name, value in [('get_video_size', (1920, 1080)), ('get_duration', 10.0)]:
+            patcher = mock.patch.object(synthesize, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def fake_run_ffmpeg(self, write_master=True):
+        def run_ffmpeg(command, outputs, **kwargs):
+            self.commands.append((command, outputs))
+            for _, path in outputs:
+                if path.endswith('.tmp'):
+                    open(path, 'w').close()
+            if write_master:
+                open(os.path.join(self.folder, 'hls', 'master.m3u8'), 'w').close()
+            return True
+        return run_ffmpeg
+
+    def option(self, options, name):
+        return options[options.index(name) + 1]
+
+    def test_hls_command(self):
+        with mock.patch.object(synthesize, 'run_ffmpeg', self.fake_run_ffmpeg()):
+            result = synthesize.synthesize_renditions(self.folder, renditions=['360p', '720p'], hls=True)
+        self.assertEqual(result, os.path.join(self.folder, 'hls', 'master.m3u8'))
+
+        command, outputs = self.commands[0]
+        filter_complex = self.option(command, '-filter_complex')
+        self.assertIn('[v]split=2[s0][s1]', filter_complex)
+        self.assertIn('[s0]scale=1280:720[v0]', filter_complex)
+        self.assertIn('[s1]scale=640:360[v1]', filter_complex)
+        self.assertIn('[a]asplit=2[a0][a1]', filter_complex)
+
+        (options, path), = outputs
+        self.assertEqual(path, os.path.abspath(os.path.join(self.folder, 'hls', '%v', 'index.m3u8')))
+        self.assertEqual(self.option(options, '-var_stream_map'), 'v:0,a:0,name:720p v:1,a:1,name:360p')
+        self.assertEqual(self.option(options, '-master_pl_name'), 'master.m3u8')
+        self.assertEqual(self.option(options, '-b:v:0'), synthesize.rendition_bitrates['720p'])
+        self.assertEqual(self.option(options, '-b:v:1'), synthesize.rendition_bitrates['360p'])
+        self.assertTrue(os.path.isdir(os.path.join(self.folder, 'hls', '720p')))
+
+    def test_missing_master_playlist_raises(self):
+        with mock.patch.object(synthesize, 'run_ffmpeg', self.fake_run_ffmpeg(write_master=False)):
+            with self.assertRaises(Exception):
+                synthesize.synthesize_renditions(self.folder, renditions=['720p'], hls=True)
+
+    def test_mp4_renditions(self):
+        with mock.patch.object(synthesize, 'run_ffmpeg', self.fake_run_ffmpeg(write_master=False)):
+            result = synthesize.synthesize_renditions(self.folder, renditions=['480p', '1080p'], burn_subtitles=False)
+        self.assertEqual(result, os.path.abspath(os.path.join(self.folder, 'video_1080p.mp4')))
+        command, outputs = self.commands[0]
+        self.assertIn('[s1]scale=852:480[v1]', self.option(command, '-filter_complex'))
+        self.assertEqual([os.path.basename(path) for _, path in outputs], ['video_1080p.mp4.tmp', 'video_480p.mp4.tmp'])
+        # 软字幕封装进每一路输出
+        for options, _ in outputs:
+            self.assertIn('mov_text', options)
+        for name in ['video_1080p.mp4', 'video_480p.mp4']:
+            self.assertTrue(os.path.exists(os.path.join(self.folder, name)))
+
+    def test_synthesize_all_passes_hls_option(self):
+        with mock.patch.object(synthesize, 'synthesize_renditions', return_value='master.m3u8') as renditions:
+            _, output = synthesize.synthesize_all_video_under_folder(self.folder, renditions=['720p'], hls=True)
+        self.assertEqual(output, 'master.m3u8')
+        self.assertEqual(renditions.call_args.kwargs['renditions'], ['720p'])
+        self.assertTrue(renditions.call_args.kwargs['hls'])
+
+
+if __name__ == '__main__':
+    unittest.main()
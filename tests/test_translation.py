@@ -0,0 +1,48 @@
+import unittest
+from unittest import mock
+
+try:
+    from tools import step030_translation as translation_module
+except Exception:  # 翻译依赖未安装，或导入时无法联网
+    translation_module = None
+
+SUMMARY = {'title': 'Test video', 'summary': 'A short test video.'}
+TEXT = 'Hello world, this is a simple test sentence.'
+
+
+@unittest.skipIf(translation_module is None, 'translation dependencies are not available')
+class TestValidTranslation(unittest.TestCase):
+    def test_empty_translation_is_invalid(self):
+        for translation in ['', '   ', '“”', '""']:
+            success, _ = translation_module.valid_translation(TEXT, translation)
+            self.assertFalse(success, translation)
+
+    def test_plain_translation_is_valid(self):
+        self.assertEqual(translation_module.valid_translation(TEXT, '你好世界'), (True, '你好世界'))
+
+
+@unittest.skipIf(translation_module is None, 'translation dependencies are not available')
+class TestConstrainedRetry(unittest.TestCase):
+    def translate(self, responses):
+        stats = {}
+        with mock.patch.object(translation_module, 'constrained_decoding', True), \
+                mock.patch.object(translation_module, 'constrained_translation_response', side_effect=responses), \
+                mock.patch.object(translation_module, 'count_message_tokens', return_value=0), \
+                mock.patch.object(translation_module.time, 'sleep'):
+            result = translation_module._translate(SUMMARY, [{'text': TEXT}], method='LLM', stats=stats)
+        return result, stats
+
+    def test_empty_constrained_output_is_retried(self):
+        result, stats = self.translate(['', '你好世界，这是一个简单的测试句子。'])
+        self.assertEqual(result, ['你好世界，这是一个简单的测试句子。'])
+        self.assertEqual(stats['translation_retries'], 1)
+        self.assertEqual(stats['failed_lines'], 0)
+
+    def test_always_empty_keeps_source_text(self):
+        result, stats = self.translate([''] * 10)
+        self.assertEqual(result, [TEXT])
+        self.assertEqual(stats['failed_lines'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+try:
+    import yt_dlp
+except ImportError:
+    sys.modules['yt_dlp'] = types.ModuleType('yt_dlp')
+
+from tools import metadata_cache
+from tools import step000_video_downloader as downloader
+
+PLAYLIST = 'https://example.com/playlist'
+
+
+class FakeYoutubeDL:
+    """按 URL 返回预设的信息，记录并发数和实例是否关闭"""
+    instances = []
+    behaviours = {}
+    lock = threading.Lock()
+    running = 0
+    max_running = 0
+
+    def __init__(self, params=None):
+        self.params = params or {}
+        self.closed = False
+        with FakeYoutubeDL.lock:
+            FakeYoutubeDL.instances.append(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.closed = True
+
+    @staticmethod
+    def sanitize_info(info):
+        return dict(info)
+
+    def extract_info(self, url, download=False):
+        if url == PLAYLIST:
+            return {'entries': [{'url': entry_url, 'id': entry_url, 'title': entry_url}
+                                for entry_url in FakeYoutubeDL.behaviours]}
+        with FakeYoutubeDL.lock:
+            FakeYoutubeDL.running += 1
+            FakeYoutubeDL.max_running = max(FakeYoutubeDL.max_running, FakeYoutubeDL.running)
+        try:
+            behaviour = FakeYoutubeDL.behaviours[url]
+            if behaviour is not None:
+                behaviour()
+            return {'id': url, 'title': url, 'webpage_url': url, 'upload_date': '20240101'}
+        finally:
+            with FakeYoutubeDL.lock:
+                FakeYoutubeDL.running -= 1
+
+
+class TestGetInfoList(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.old_cache_path = metadata_cache.cache_path
+        metadata_cache.cache_path = os.path.join(self.tmp.name, 'metadata.sqlite3')
+        metadata_cache.initialized = False
+        FakeYoutubeDL.instances = []
+        FakeYoutubeDL.behaviours = {}
+        FakeYoutubeDL.max_running = 0
+        patcher = mock.patch.object(downloader.yt_dlp, 'YoutubeDL', FakeYoutubeDL, create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        metadata_cache.cache_path = self.old_cache_path
+        metadata_cache.initialized = False
+        self.tmp.cleanup()
+
+    def test_yields_in_completion_order(self):
+        release = threading.Event()
+        FakeYoutubeDL.behaviours = {'slow': lambda: release.wait(5), 'fast': None}
+        results = downloader.get_info_list_from_url(PLAYLIST, 2, workers=2)
+        self.assertEqual(next(results)['id'], 'fast')
+        release.set()
+        self.assertEqual([info['id'] for info in results], ['slow'])
+
+    def test_respects_worker_limit(self):
+        FakeYoutubeDL.behaviours = {f'video{i}': lambda: time.sleep(0.05) for i in range(6)}
+        results = list(downloader.get_info_list_from_url(PLAYLIST, 6, workers=2))
+        self.assertEqual(len(results), 6)
+        self.assertLessEqual(FakeYoutubeDL.max_running, 2)
+
+    def test_failing_entry_does_not_stop_generator(self):
+        def fail():
+            raise RuntimeError('unavailable')
+        FakeYoutubeDL.behaviours = {'ok1': None, 'broken': fail, 'ok2': None}
+        results = list(downloader.get_info_list_from_url(PLAYLIST, 3, workers=2))
+        self.assertEqual(sorted(info['id'] for info in results), ['ok1', 'ok2'])
+
+    def test_closes_all_instances(self):
+        FakeYoutubeDL.behaviours = {f'video{i}': lambda: time.sleep(0.01) for i in range(4)}
+        list(downloader.get_info_list_from_url(PLAYLIST, 4, workers=2))
+        self.assertGreater(len(FakeYoutubeDL.instances), 1)
+        self.assertTrue(all(ydl.closed for ydl in FakeYoutubeDL.instances))
+
+    def test_cached_videos_are_not_extracted_again(self):
+        FakeYoutubeDL.behaviours = {'video0': None, 'video1': None}
+        list(downloader.get_info_list_from_url(PLAYLIST, 2, workers=2))
+        FakeYoutubeDL.instances = []
+        results = list(downloader.get_info_list_from_url(PLAYLIST, 2, workers=2))
+        self.assertEqual(sorted(info['id'] for info in results), ['video0', 'video1'])
+        self.assertEqual(len(FakeYoutubeDL.instances), 1)
+
+
+class TestPrefetchVideos(unittest.TestCase):
+    def test_failed_download_yields_none(self):
+        def download(info, folder_path, resolution):
+            if info['title'] == 'broken':
+                raise RuntimeError('download failed')
+            return os.path.join(folder_path, info['title'])
+
+        infos = [{'title': 'a'}, {'title': 'broken'}, {'title': 'b'}]
+        with mock.patch.object(downloader, 'download_single_video', download):
+            results = dict((info['title'], folder) for info, folder in downloader.prefetch_videos(iter(infos), 'videos', workers=2))
+        self.assertEqual(results, {'a': os.path.join('videos', 'a'), 'broken': None, 'b': os.path.join('videos', 'b')})
+
+    def test_limits_downloads_ahead_of_consumer(self):
+        started = []
+
+        def download(info, folder_path, resolution):
+            started.append(info['title'])
+            return info['title']
+
+        infos = iter([{'title': f'video{i}'} for i in range(10)])
+        with mock.patch.object(downloader, 'download_single_video', download):
+            results = downloader.prefetch_videos(infos, 'videos', workers=2, max_ahead=2)
+            next(results)
+            time.sleep(0.2)
+            # 第一个视频还在处理中，最多只领先 2 个
+            self.assertEqual(len(started), 2)
+            next(results)
+            time.sleep(0.2)
+            self.assertEqual(len(started), 3)
+            self.assertEqual(len(list(results)), 8)
+        self.assertEqual(len(started), 10)
+
+    def test_closing_early_does_not_wait_for_downloads(self):
+        release = threading.Event()
+
+        def download(info, folder_path, resolution):
+            if info['title'] != 'first':
+                release.wait(5)
+            return info['title']
+
+        infos = iter([{'title': 'first'}] + [{'title': f'video{i}'} for i in range(5)])
+        with mock.patch.object(downloader, 'download_single_video', download):
+            results = downloader.prefetch_videos(infos, 'videos', workers=1, max_ahead=3)
+            self.assertEqual(next(results)[1], 'first')
+            t_start = time.time()
+            results.close()
+            self.assertLess(time.time() - t_start, 1)
+            release.set()
+
+    def test_failing_info_iter_ends_generator(self):
+        def infos():
+            yield {'title': 'a'}
+            raise RuntimeError('listing failed')
+
+        with mock.patch.object(downloader, 'download_single_video', lambda info, folder_path, resolution: folder_path):
+            results = list(downloader.prefetch_videos(infos(), 'videos', workers=2))
+        self.assertEqual(results, [({'title': 'a'}, 'videos')])
+
+
+if __name__ == '__main__':
+    unittest.main()
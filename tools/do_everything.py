@@ -5,7 +5,9 @@ import traceback
 
 import torch
 from loguru import logger
-from .step000_video_downloader import get_info_list_from_url, download_single_video, get_target_folder
+from .step000_video_downloader import get_info_list_from_url, download_single_video, get_target_folder, prefetch_videos, \
+    download_audio_first, wait_for_video
+from .step005_ingest import ingest, register, link_or_copy, stage_done, record_stage, media_fingerprint
 from .step010_demucs_vr import separate_all_audio_under_folder, init_demucs, release_model
 from .step020_asr import transcribe_all_audio_under_folder
 from .step021_asr_whisperx import init_whisperx, init_diarize
@@ -92,18 +94,31 @@ def initialize_models(tts_method, asr_method, diarization):
             raise
 
 
+def stage_progress(progress_callback, base, weight):
+    """把阶段内的百分比映射到整体进度 [base, base + weight]"""
+    if progress_callback is None:
+        return None
+    return lambda percent, status: progress_callback(int(base + weight * percent / 100), status)
+
+
 def process_video(info, root_folder, resolution,
                   demucs_model, device, shifts,
                   asr_method, whisper_model, batch_size, diarization, whisper_min_speakers, whisper_max_speakers,
                   translation_method, translation_target_language,
                   tts_method, tts_target_language, voice,
                   subtitles, speed_up, fps, background_music, bgm_volume, video_volume,
-                  target_resolution, max_retries, progress_callback=None):
+                  target_resolution, max_retries, progress_callback=None, burn_subtitles=True, audio_first=False,
+                  watermark_path='f_logo.png', renditions=None, hls=False):
     """
     处理单个视频的完整流程，增加了进度回调函数
 
     Args:
         progress_callback: 回调函数，用于报告进度和状态，格式为 progress_callback(progress_percent, status_message)
+        burn_subtitles: 是否把字幕烧录进画面（需要重新编码），为 False 时封装为软字幕，条件允许时直接复制视频流
+        audio_first: 是否先只下载音轨，视频在后台下载，到视频合成阶段再等待
+        watermark_path: 水印图片，不存在时不加水印
+        renditions: 一次输出的多个分辨率（如 ['1080p', '720p']），为空时只输出 target_resolution 的 video.mp4
+        hls: 是否输出 HLS（hls/master.m3u8 和各分辨率的分片），分辨率取自 renditions
     """
     local_time = time.localtime()
 
@@ -120,6 +135,17 @@ def process_video(info, root_folder, resolution,
     current_stage = 0
     progress_base = 0
 
+    # 各阶段影响产物的参数，内容相同且参数一致的阶段直接复用之前的结果；水印按图片内容区分
+    watermark = media_fingerprint(watermark_path) if watermark_path and os.path.exists(watermark_path) else None
+    stage_params = {
+        'separation': [demucs_model, shifts],
+        'asr': [asr_method, whisper_model, diarization, whisper_min_speakers, whisper_max_speakers],
+        'translation': [translation_method, translation_target_language],
+        'tts': [tts_method, tts_target_language, voice],
+        'synthesis': [subtitles, speed_up, fps, background_music, bgm_volume, video_volume, target_resolution, burn_subtitles,
+                      watermark, renditions, hls],
+    }
+
     # 报告初始进度
     if progress_callback:
         progress_callback(0, "准备处理...")
@@ -141,13 +167,15 @@ def process_video(info, root_folder, resolution,
                     logger.warning(error_msg)
                     return False, None, error_msg
 
-                folder = download_single_video(info, root_folder, resolution)
+                download_video = download_audio_first if audio_first else download_single_video
+                folder = download_video(info, root_folder, resolution)
                 if folder is None:
                     error_msg = f'下载视频失败: {info["title"]}'
                     logger.warning(error_msg)
                     return False, None, error_msg
 
             logger.info(f'处理视频: {folder}')
+            reused = ingest(folder, stage_params)
 
             # 完成下载阶段，进入人声分离阶段
             current_stage += 1
@@ -156,15 +184,20 @@ def process_video(info, root_folder, resolution,
             if progress_callback:
                 progress_callback(progress_base, stage_name)
 
+            # 人声分离、语音识别和翻译在产物已存在时直接沿用，只有本次真正生成时才记录参数
+            existed = stage_done(folder, 'separation')
             try:
                 status, vocals_path, _ = separate_all_audio_under_folder(
-                    folder, model_name=demucs_model, device=device, progress=True, shifts=shifts)
+                    folder, model_name=demucs_model, device=device, progress=True, shifts=shifts,
+                    progress_callback=stage_progress(progress_callback, progress_base, stage_weight))
                 logger.info(f'人声分离完成: {vocals_path}')
             except Exception as e:
                 stack_trace = traceback.format_exc()
                 error_msg = f'人声分离失败: {str(e)}\n{stack_trace}'
                 logger.error(error_msg)
                 return False, None, error_msg
+            if not existed:
+                record_stage(folder, 'separation', stage_params['separation'])
 
             # 完成人声分离阶段，进入语音识别阶段
             current_stage += 1
@@ -173,6 +206,7 @@ def process_video(info, root_folder, resolution,
             if progress_callback:
                 progress_callback(progress_base, stage_name)
 
+            existed = stage_done(folder, 'asr')
             try:
                 status, result_json = transcribe_all_audio_under_folder(
                     folder, asr_method=asr_method, whisper_model_name=whisper_model, device=device,
@@ -185,6 +219,8 @@ def process_video(info, root_folder, resolution,
                 error_msg = f'语音识别失败: {str(e)}\n{stack_trace}'
                 logger.error(error_msg)
                 return False, None, error_msg
+            if not existed:
+                record_stage(folder, 'asr', stage_params['asr'])
 
             # 完成语音识别阶段，进入翻译阶段
             current_stage += 1
@@ -193,6 +229,7 @@ def process_video(info, root_folder, resolution,
             if progress_callback:
                 progress_callback(progress_base, stage_name)
 
+            existed = stage_done(folder, 'translation')
             try:
                 status, summary, translation = translate_all_transcript_under_folder(
                     folder, method=translation_method, target_language=translation_target_language)
@@ -202,6 +239,8 @@ def process_video(info, root_folder, resolution,
                 error_msg = f'翻译失败: {str(e)}\n{stack_trace}'
                 logger.error(error_msg)
                 return False, None, error_msg
+            if not existed:
+                record_stage(folder, 'translation', stage_params['translation'])
 
             # 完成翻译阶段，进入语音合成阶段
             current_stage += 1
@@ -219,6 +258,8 @@ def process_video(info, root_folder, resolution,
                 error_msg = f'语音合成失败: {str(e)}\n{stack_trace}'
                 logger.error(error_msg)
                 return False, None, error_msg
+            # 语音合成每次都按片段缓存键重新生成并混音，总是与当前参数一致
+            record_stage(folder, 'tts', stage_params['tts'])
 
             # 完成语音合成阶段，进入视频合成阶段
             current_stage += 1
@@ -227,16 +268,32 @@ def process_video(info, root_folder, resolution,
             if progress_callback:
                 progress_callback(progress_base, stage_name)
 
-            try:
-                status, output_video = synthesize_all_video_under_folder(
-                    folder, subtitles=subtitles, speed_up=speed_up, fps=fps, resolution=target_resolution,
-                    background_music=background_music, bgm_volume=bgm_volume, video_volume=video_volume)
-                logger.info(f'视频合成完成: {output_video}')
-            except Exception as e:
-                stack_trace = traceback.format_exc()
-                error_msg = f'视频合成失败: {str(e)}\n{stack_trace}'
-                logger.error(error_msg)
-                return False, None, error_msg
+            if 'synthesis' in reused:
+                output_video = os.path.join(folder, 'video.mp4')
+                logger.info(f'复用已合成的视频: {output_video}')
+            else:
+                # 先下载音频时，视频可能还在后台下载；后台下载失败则同步重新下载一次
+                if not wait_for_video(folder) and not isinstance(info, str):
+                    download_single_video(info, root_folder, resolution)
+                    if not wait_for_video(folder):
+                        error_msg = f'下载视频失败: {info["title"]}'
+                        logger.warning(error_msg)
+                        return False, None, error_msg
+
+                try:
+                    status, output_video = synthesize_all_video_under_folder(
+                        folder, subtitles=subtitles, speed_up=speed_up, fps=fps, resolution=target_resolution,
+                        background_music=background_music, bgm_volume=bgm_volume, video_volume=video_volume,
+                        watermark_path=watermark_path, burn_subtitles=burn_subtitles, renditions=renditions, hls=hls,
+                        progress_callback=stage_progress(progress_callback, progress_base, stage_weight))
+                    logger.info(f'视频合成完成: {output_video}')
+                except Exception as e:
+                    stack_trace = traceback.format_exc()
+                    error_msg = f'视频合成失败: {str(e)}\n{stack_trace}'
+                    logger.error(error_msg)
+                    return False, None, error_msg
+                record_stage(folder, 'synthesis', stage_params['synthesis'])
+            register(folder, stage_params)
 
             # 完成所有阶段，报告100%进度
             if progress_callback:
@@ -263,12 +320,16 @@ def do_everything(root_folder, url, num_videos=5, resolution='1080p',
                   tts_method='xtts', tts_target_language='中文', voice='zh-CN-XiaoxiaoNeural',
                   subtitles=True, speed_up=1.00, fps=30,
                   background_music=None, bgm_volume=0.5, video_volume=1.0, target_resolution='1080p',
-                  max_workers=3, max_retries=5, progress_callback=None):
+                  max_workers=3, max_retries=5, progress_callback=None, burn_subtitles=True, audio_first=False,
+                  renditions=None, hls=False):
     """
     处理整个视频处理流程，增加了进度回调函数
 
     Args:
         progress_callback: 回调函数，用于报告进度和状态，格式为 progress_callback(progress_percent, status_message)
+        burn_subtitles: 是否把字幕烧录进画面（需要重新编码），为 False 时封装为软字幕，条件允许时直接复制视频流
+        audio_first: 是否先只下载音轨，让人声分离和语音识别不必等待视频下载完成
+        renditions, hls: 多分辨率和 HLS 输出，见 process_video
     """
     try:
         success_list = []
@@ -302,7 +363,6 @@ def do_everything(root_folder, url, num_videos=5, resolution='1080p',
         out_video = None
         if url.endswith('.mp4'):
             try:
-                import shutil
                 # 获取原始视频文件名（不带路径）
                 original_file_name = os.path.basename(url)
 
@@ -321,8 +381,10 @@ def do_everything(root_folder, url, num_videos=5, resolution='1080p',
                 # 构建新位置的完整路径
                 new_file_path = os.path.join(new_folder_path, "download.mp4")
 
-                # 将视频文件移动到新创建的文件夹中并重命名
-                shutil.copy(original_file_path, new_file_path)
+                # 将视频文件链接（不支持时复制）到新创建的文件夹中并重命名
+                if os.path.exists(new_file_path):
+                    os.remove(new_file_path)
+                link_or_copy(original_file_path, new_file_path)
                 # 在 root_folder 下创建该文件夹
                 os.makedirs(new_folder_path, exist_ok=True)
 
@@ -333,7 +395,8 @@ def do_everything(root_folder, url, num_videos=5, resolution='1080p',
                     translation_method, translation_target_language,
                     tts_method, tts_target_language, voice,
                     subtitles, speed_up, fps, background_music, bgm_volume, video_volume,
-                    target_resolution, max_retries, progress_callback
+                    target_resolution, max_retries, progress_callback,
+                    burn_subtitles=burn_subtitles, renditions=renditions, hls=hls
                 )
 
                 if success:
@@ -348,17 +411,12 @@ def do_everything(root_folder, url, num_videos=5, resolution='1080p',
                 return f"处理本地视频失败: {str(e)}", None
         else:
             try:
-                videos_info = []
                 if progress_callback:
                     progress_callback(10, "获取视频信息中...")
 
-                for video_info in get_info_list_from_url(urls, num_videos):
-                    videos_info.append(video_info)
-
-                if not videos_info:
-                    return "获取视频信息失败，请检查URL是否正确", None
-
-                for info in videos_info:
+                # 视频信息边解析边下载，先下载完的先处理；下载失败的由 process_video 重试
+                for info, _ in prefetch_videos(get_info_list_from_url(urls, num_videos), root_folder, resolution,
+                                                 audio_first=audio_first):
                     try:
                         success, output_video, error_msg = process_video(
                             info, root_folder, resolution,
@@ -368,7 +426,8 @@ def do_everything(root_folder, url, num_videos=5, resolution='1080p',
                             translation_method, translation_target_language,
                             tts_method, tts_target_language, voice,
                             subtitles, speed_up, fps, background_music, bgm_volume, video_volume,
-                            target_resolution, max_retries, progress_callback
+                            target_resolution, max_retries, progress_callback,
+                            burn_subtitles=burn_subtitles, audio_first=audio_first, renditions=renditions, hls=hls
                         )
 
                         if success:
@@ -391,6 +450,9 @@ def do_everything(root_folder, url, num_videos=5, resolution='1080p',
                 logger.error(f"获取视频列表失败: {str(e)}\n{stack_trace}")
                 return f"获取视频列表失败: {str(e)}", None
 
+        if not url.endswith('.mp4') and not success_list and not fail_list:
+            return "获取视频信息失败，请检查URL是否正确", None
+
         # 记录处理结果汇总
         logger.info("-" * 50)
         logger.info(f"处理完成: 成功={len(success_list)}, 失败={len(fail_list)}")
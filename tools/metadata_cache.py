@@ -0,0 +1,77 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from loguru import logger
+
+# 视频信息缓存：播放列表/频道的条目列表按 TTL 过期，单个视频的信息永久保存；
+# 另外记录每个媒体内容指纹对应的已处理文件夹和处理参数，用于去重
+cache_path = os.getenv('METADATA_CACHE_PATH', 'cache/metadata.sqlite3')
+listing_ttl = float(os.getenv('METADATA_LISTING_TTL', 6 * 3600))
+
+init_lock = threading.Lock()
+initialized = False
+
+@contextmanager
+def connect():
+    """每次操作使用独立连接，可在多个线程中并发使用"""
+    global initialized
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+    conn = sqlite3.connect(cache_path, timeout=30)
+    try:
+        with init_lock:
+            if not initialized:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('CREATE TABLE IF NOT EXISTS listings (url TEXT, playlistend INTEGER, entries TEXT, fetched REAL, PRIMARY KEY (url, playlistend))')
+                conn.execute('CREATE TABLE IF NOT EXISTS videos (url TEXT PRIMARY KEY, info TEXT, fetched REAL)')
+                conn.execute('CREATE TABLE IF NOT EXISTS fingerprints (fingerprint TEXT PRIMARY KEY, folder TEXT, params TEXT, fetched REAL)')
+                initialized = True
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def get_listing(url, playlistend):
+    """未过期时返回缓存的播放列表条目（只含 url、id、title），否则返回 None"""
+    with connect() as conn:
+        row = conn.execute('SELECT entries, fetched FROM listings WHERE url = ? AND playlistend = ?',
+                           (url, playlistend or 0)).fetchone()
+    if row is None or time.time() - row[1] > listing_ttl:
+        return None
+    return json.loads(row[0])
+
+def put_listing(url, playlistend, entries):
+    with connect() as conn:
+        conn.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)',
+                     (url, playlistend or 0, json.dumps(entries, ensure_ascii=False), time.time()))
+
+def get_video(url):
+    if not url:
+        return None
+    with connect() as conn:
+        row = conn.execute('SELECT info FROM videos WHERE url = ?', (url, )).fetchone()
+    return json.loads(row[0]) if row else None
+
+def put_video(info, *urls):
+    """info 需可 JSON 序列化（yt-dlp 的信息先经 sanitize_info），同时登记在 webpage_url 和 urls 下"""
+    urls = {url for url in (info.get('webpage_url'), *urls) if url}
+    try:
+        data = json.dumps(info, ensure_ascii=False)
+    except (TypeError, ValueError) as e:
+        logger.warning(f'视频信息无法缓存: {e}')
+        return
+    with connect() as conn:
+        conn.executemany('INSERT OR REPLACE INTO videos VALUES (?, ?, ?)', [(url, data, time.time()) for url in urls])
+
+def get_fingerprint(fingerprint):
+    """返回处理过同样内容的 (文件夹, 各阶段参数)，没有时返回 None"""
+    with connect() as conn:
+        row = conn.execute('SELECT folder, params FROM fingerprints WHERE fingerprint = ?', (fingerprint, )).fetchone()
+    return (row[0], json.loads(row[1])) if row else None
+
+def put_fingerprint(fingerprint, folder, params):
+    with connect() as conn:
+        conn.execute('INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)',
+                     (fingerprint, folder, json.dumps(params, ensure_ascii=False), time.time()))
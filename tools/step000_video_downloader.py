@@ -1,8 +1,27 @@
 import os
 import re
+import queue
+import threading
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from loguru import logger
 import yt_dlp
 import json
+from .utils import find_media_source
+from . import metadata_cache
+
+# 并发解析视频信息的线程数、同时下载的视频数，以及每个视频分片并发下载数
+metadata_workers = int(os.getenv('YTDLP_METADATA_WORKERS', 4))
+download_workers = int(os.getenv('YTDLP_DOWNLOAD_WORKERS', 3))
+fragment_workers = int(os.getenv('YTDLP_FRAGMENT_WORKERS', 4))
+# 边解析边下载时最多领先处理进度多少个视频（正在下载和已下载未处理的合计），避免长播放列表占满磁盘
+prefetch_ahead = int(os.getenv('YTDLP_PREFETCH_AHEAD', 6))
+
+# 先下载音频时，视频流在后台线程下载，按视频目录登记，合成前用 wait_for_video 等待
+video_executor = ThreadPoolExecutor(download_workers)
+video_futures = {}
+video_futures_lock = threading.Lock()
+
 def sanitize_title(title):
     # Only keep numbers, letters, Chinese characters, and spaces
     title = re.sub(r'[^\w\u4e00-\u9fff \d_-]', '', title)
@@ -12,6 +31,9 @@ def sanitize_title(title):
 
 
 def get_target_folder(info, folder_path):
+    # 扁平列表里的条目没有上传者和日期，从缓存的完整信息里取
+    if 'upload_date' not in info:
+        info = metadata_cache.get_video(info.get('webpage_url') or info.get('url')) or info
     sanitized_title = sanitize_title(info['title'])
     sanitized_uploader = sanitize_title(info.get('uploader', 'Unknown'))
     upload_date = info.get('upload_date', 'Unknown')
@@ -42,23 +64,83 @@ def download_single_video(info, folder_path, resolution='1080p'):
         'writeinfojson': True,
         'writethumbnail': True,
         'outtmpl': os.path.join(folder_path, sanitized_uploader, f'{upload_date} {sanitized_title}', 'download'),
+        **download_options(),
+    }
+
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        ydl.download([info['webpage_url']])
+    logger.info(f'Video downloaded in {output_folder}')
+    return output_folder
+
+def download_options():
+    return {
         'ignoreerrors': True,
+        # 分片并发下载；中断后保留 .part 文件，下次从断点继续
+        'concurrent_fragment_downloads': fragment_workers,
+        'continuedl': True,
+        'retries': 10,
+        'fragment_retries': 10,
         'cookiefile' : 'cookies.txt' if os.path.exists("cookies.txt") else None, # 得到cookies yt-dlp --cookies-from-browser chrome --cookies cookies.txt
         # 'cookiesfrombrowser': ('chrome', ), # 从chrome浏览器中获取cookie 
         # 'cookiesfrombrowser': ('firefox', 'default', None, 'Meta') # 从firefox浏览器中获取cookie
     }
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([info['webpage_url']])
-    logger.info(f'Video downloaded in {output_folder}')
+def download_audio_first(info, folder_path, resolution='1080p'):
+    """
+    先只下载最佳音轨为 download_audio.*，人声分离和语音识别可以马上开始；
+    视频在后台线程下载为 download.mp4，合成前用 wait_for_video 等待。
+    """
+    output_folder = get_target_folder(info, folder_path)
+    if output_folder is None:
+        return None
+    if os.path.exists(os.path.join(output_folder, 'download.mp4')):
+        logger.info(f'Video already downloaded in {output_folder}')
+        return output_folder
+
+    if find_media_source(output_folder) is None:
+        ydl_opts = {
+            'format': 'bestaudio/best',
+            'writeinfojson': True,
+            # 信息文件仍写为 download.info.json，翻译阶段不必等视频下载完
+            'outtmpl': {'default': os.path.join(output_folder, 'download_audio'),
+                        'infojson': os.path.join(output_folder, 'download')},
+            **download_options(),
+        }
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            ydl.download([info['webpage_url']])
+        if find_media_source(output_folder) is None:
+            return None
+        logger.info(f'Audio downloaded in {output_folder}')
+
+    with video_futures_lock:
+        if output_folder not in video_futures:
+            video_futures[output_folder] = video_executor.submit(download_single_video, info, folder_path, resolution)
     return output_folder
 
+def wait_for_video(folder, timeout=None):
+    """等待 download_audio_first 登记的后台视频下载完成，返回 download.mp4 是否存在"""
+    with video_futures_lock:
+        future = video_futures.get(folder)
+    if future is not None:
+        try:
+            future.result(timeout)
+        except Exception as e:
+            logger.error(f'后台下载视频失败: {folder}: {e}')
+        with video_futures_lock:
+            video_futures.pop(folder, None)
+    return os.path.exists(os.path.join(folder, 'download.mp4'))
+
 def download_videos(info_list, folder_path, resolution='1080p'):
     for info in info_list:
         output_folder = download_single_video(info, folder_path, resolution)
     return output_folder
 
-def get_info_list_from_url(url, num_videos):
+def get_info_list_from_url(url, num_videos, workers=metadata_workers):
+    """
+    先只列出播放列表的条目（extract_flat），再在线程池里并发解析每个视频的完整信息，
+    按解析完成的顺序逐个产出，不必等整个列表解析完。
+    列表和视频信息都经过 metadata_cache：列表过期前不再请求，已解析过的视频直接从缓存产出。
+    """
     if isinstance(url, str):
         url = [url]
 
@@ -70,22 +152,121 @@ def get_info_list_from_url(url, num_videos):
         'playlistend': num_videos,
         'ignoreerrors': True
     }
+    # YoutubeDL 实例不是线程安全的，每个线程各用一个，登记到 instances 里，结束时统一关闭
+    local = threading.local()
+    instances_lock = threading.Lock()
 
-    # video_info_list = []
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+    def extract(entry_url):
+        if not hasattr(local, 'ydl'):
+            with instances_lock:
+                local.ydl = instances.enter_context(yt_dlp.YoutubeDL(ydl_opts))
+        result = local.ydl.extract_info(entry_url, download=False)
+        if result is not None and 'entries' not in result:
+            result = yt_dlp.YoutubeDL.sanitize_info(result)
+            metadata_cache.put_video(result, entry_url)
+        return result
+
+    # 退出时先等线程池结束，再关闭各线程的 YoutubeDL 实例
+    with ExitStack() as instances, yt_dlp.YoutubeDL({**ydl_opts, 'extract_flat': 'in_playlist'}) as ydl, \
+            ThreadPoolExecutor(workers) as executor:
+        futures = []
         for u in url:
-            result = ydl.extract_info(u, download=False)
-            if 'entries' in result:
+            cached = metadata_cache.get_video(u)
+            if cached is not None:
+                yield cached
+                continue
+            entries = metadata_cache.get_listing(u, num_videos)
+            if entries is None:
+                result = ydl.extract_info(u, download=False)
+                if result is None:
+                    continue
+                if 'entries' not in result:
+                    # Single video
+                    result = yt_dlp.YoutubeDL.sanitize_info(result)
+                    metadata_cache.put_video(result, u)
+                    yield result
+                    continue
                 # Playlist
-                # video_info_list.extend(result['entries'])
-                for video_info in result['entries']:
+                entries = [{'url': entry.get('webpage_url') or entry.get('url'), 'id': entry.get('id'), 'title': entry.get('title')}
+                           for entry in result['entries'] if entry is not None]
+                metadata_cache.put_listing(u, num_videos, entries)
+            # 只有缓存里没有的新视频才需要完整解析
+            for entry in entries:
+                cached = metadata_cache.get_video(entry['url'])
+                if cached is not None:
+                    yield cached
+                else:
+                    futures.append(executor.submit(extract, entry['url']))
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.warning(f'解析视频信息失败: {e}')
+                continue
+            if result is None:
+                continue
+            # 频道的条目可能是子列表（如“视频”“直播”标签页），完整解析后已包含各视频信息
+            for video_info in result.get('entries') or [result]:
+                if video_info is not None:
                     yield video_info
+
+def prefetch_videos(info_iter, folder_path, resolution='1080p', workers=download_workers, audio_first=False, max_ahead=prefetch_ahead):
+    """
+    边解析边下载：info_iter 每产出一个视频就提交到下载线程池，按下载完成的顺序产出 (info, 文件夹)，
+    下载失败时文件夹为 None。调用方处理前一个视频时，后面的视频继续在后台下载，
+    但正在下载和已下载未处理的视频合计不超过 max_ahead 个，调用方取下一个时才腾出位置。
+    audio_first 为 True 时音轨下载完就产出，视频由 download_audio_first 在后台继续下载。
+    提前关闭生成器时不再提交新的下载，排队中的下载取消，不等待正在进行的下载。
+    """
+    download_video = download_audio_first if audio_first else download_single_video
+    results = queue.Queue()
+    executor = ThreadPoolExecutor(workers)
+    slots = threading.Semaphore(max(1, max_ahead))
+    stopped = threading.Event()
+    futures = []
+
+    def download(info):
+        try:
+            folder = download_video(info, folder_path, resolution)
+        except Exception as e:
+            logger.error(f'下载视频失败: {info.get("title")}: {e}')
+            folder = None
+        results.put((info, folder))
+
+    def feed():
+        try:
+            for info in info_iter:
+                while not slots.acquire(timeout=0.5):
+                    if stopped.is_set():
+                        return
+                if stopped.is_set():
+                    return
+                futures.append(executor.submit(download, info))
+        except Exception as e:
+            if not stopped.is_set():
+                logger.error(f'获取视频信息失败: {e}')
+        finally:
+            if stopped.is_set():
+                # 调用方已不再需要后面的视频，停止解析列表
+                if hasattr(info_iter, 'close'):
+                    info_iter.close()
             else:
-                # Single video
-                # video_info_list.append(result)
-                yield result
+                wait(futures)
+            results.put(None)
 
-    # return video_info_list
+    threading.Thread(target=feed, daemon=True).start()
+    try:
+        while True:
+            item = results.get()
+            if item is None:
+                break
+            yield item
+            slots.release()
+    finally:
+        stopped.set()
+        for future in list(futures):
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
 
 def download_from_url(url, folder_path, resolution='1080p', num_videos=5):
     resolution = resolution.replace('p', '')
@@ -116,8 +297,14 @@ def download_from_url(url, folder_path, resolution='1080p', num_videos=5):
                 # Single video
                 video_info_list.append(result)
         
-    # Now download videos with sanitized titles
-    example_output_folder = download_videos(video_info_list, folder_path, resolution)
+    # Now download videos with sanitized titles，与一键处理共用下载线程池并发下载
+    example_output_folder = None
+    for _, output_folder in prefetch_videos(iter(video_info_list), folder_path, resolution):
+        if output_folder is not None:
+            example_output_folder = output_folder
+    if example_output_folder is None:
+        return f"No videos were downloaded under the {folder_path} folder", None, None
+    download_info_json = None
     if os.path.exists(os.path.join(example_output_folder, 'download.info.json')):
         download_info_json = json.load(open(os.path.join(example_output_folder, 'download.info.json'), 'r', encoding='utf-8'))
     return f"All videos have been downloaded under the {folder_path} folder", os.path.join(example_output_folder, 'download.mp4'), download_info_json
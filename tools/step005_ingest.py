@@ -0,0 +1,164 @@
+import os
+import json
+import shutil
+import hashlib
+from loguru import logger
+from . import metadata_cache
+from .utils import find_media_source
+
+# 字节指纹只读取文件开头、中间和结尾各一块，大文件也很快
+fingerprint_chunk = 1 << 20
+
+# 各阶段的产物，最后一个是该阶段完成的标志，必须存在才复用；前面的存在时一并复用
+stage_artifacts = [
+    ('separation', ['audio.wav', 'audio_vocals.wav', 'audio_instruments.wav']),
+    ('asr', ['SPEAKER', 'transcript.json']),
+    ('translation', ['summary.json', 'translation_stats.json', 'translation.json']),
+    ('tts', ['wavs', 'audio_tts.wav', 'audio_combined.wav']),
+    ('synthesis', ['subtitles.srt', 'video.mp4']),
+]
+# 文件夹内记录各阶段产物是在什么参数下生成的，只有本次生成或复用时才写入
+stage_record_file = 'stage_params.json'
+
+def media_fingerprint(path, chunk_size=fingerprint_chunk):
+    size = os.path.getsize(path)
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for offset in sorted({0, max(size // 2 - chunk_size // 2, 0), max(size - chunk_size, 0)}):
+            f.seek(offset)
+            sha256.update(f.read(chunk_size))
+    return f'{size}-{sha256.hexdigest()}'
+
+def content_keys(folder):
+    """
+    视频目录的内容标识，按优先级排列：
+    1. download.info.json 里的 extractor + id，同一视频重新下载、换了格式或封装也能对上；
+    2. 媒体文件的字节指纹，用于没有信息文件的本地视频。按来源类型区分（video: 为 download.mp4，
+       audio: 为先行下载的音轨），同一目录在视频下载完成前后得到的 key 是确定的。
+    """
+    keys = []
+    info_path = os.path.join(folder, 'download.info.json')
+    if os.path.exists(info_path):
+        try:
+            with open(info_path, 'r', encoding='utf-8') as f:
+                info = json.load(f)
+            if info.get('id') and (info.get('extractor_key') or info.get('extractor')):
+                keys.append(f'id:{info.get("extractor_key") or info.get("extractor")}:{info["id"]}')
+        except (OSError, json.JSONDecodeError):
+            pass
+    source = find_media_source(folder)
+    if source is not None:
+        kind = 'video' if os.path.basename(source) == 'download.mp4' else 'audio'
+        keys.append(f'{kind}:{media_fingerprint(source)}')
+    return keys
+
+def link_or_copy(src, dst):
+    """
+    媒体文件尽量硬链接（写入它们的阶段都是先写临时文件或只在文件不存在时写）；
+    JSON 等后续阶段会原地改写的文件则复制，避免改到原文件夹。
+    """
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, copy_function=link_or_copy, dirs_exist_ok=True)
+        return dst
+    if os.path.exists(dst):
+        return dst
+    if src.endswith(('.wav', '.mp4')):
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+def normalize_params(params):
+    return json.loads(json.dumps(params, ensure_ascii=False))
+
+def stage_done(folder, stage):
+    """该阶段的完成标志（最后一个产物）是否已存在"""
+    artifacts = dict(stage_artifacts)[stage]
+    return os.path.exists(os.path.join(folder, artifacts[-1]))
+
+def recorded_params(folder):
+    """文件夹内各阶段产物对应的参数，没有记录的阶段来源未知"""
+    path = os.path.join(folder, stage_record_file)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def record_stage(folder, stage, params):
+    """某阶段在本次运行中生成或复用了产物后调用，记录其参数"""
+    record = recorded_params(folder)
+    record[stage] = normalize_params(params)
+    path = os.path.join(folder, stage_record_file)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(record, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def verified_params(folder, stage_params):
+    """产物存在且记录的参数与 stage_params 一致的阶段及其参数"""
+    record = recorded_params(folder)
+    stage_params = normalize_params(stage_params)
+    return {stage: stage_params[stage] for stage, _ in stage_artifacts
+            if stage in stage_params and record.get(stage) == stage_params[stage] and stage_done(folder, stage)}
+
+def find_processed(folder):
+    """按 content_keys 的顺序查找处理过同样内容的其他文件夹，返回 (文件夹, 各阶段参数) 或 None"""
+    for key in content_keys(folder):
+        known = metadata_cache.get_fingerprint(key)
+        if known is None:
+            continue
+        known_folder, known_params = known
+        if os.path.abspath(known_folder) != os.path.abspath(folder) and os.path.isdir(known_folder):
+            return known_folder, known_params
+    return None
+
+def ingest(folder, stage_params):
+    """
+    查找内容相同、已经处理过的文件夹（见 content_keys），按阶段顺序把参数一致的产物
+    链接到 folder，遇到参数不同的阶段就停止，之后的阶段照常处理。
+    folder 里已有的产物不覆盖：记录的参数一致时视为已复用，否则来源不明，从该阶段起不再复用。
+    返回已复用的阶段列表，处理成功后用 register 登记。
+    """
+    known = find_processed(folder)
+    if known is None:
+        return []
+    known_folder, known_params = known
+
+    stage_params = normalize_params(stage_params)
+    record = recorded_params(folder)
+    reused = []
+    for stage, artifacts in stage_artifacts:
+        if known_params.get(stage) != stage_params.get(stage):
+            break
+        if stage_done(folder, stage):
+            if record.get(stage) != stage_params.get(stage):
+                break
+            reused.append(stage)
+            continue
+        if not stage_done(known_folder, stage):
+            break
+        for artifact in artifacts:
+            src = os.path.join(known_folder, artifact)
+            if os.path.exists(src):
+                link_or_copy(src, os.path.join(folder, artifact))
+        record_stage(folder, stage, stage_params[stage])
+        reused.append(stage)
+    if reused:
+        logger.info(f'内容与 {known_folder} 相同，复用阶段: {", ".join(reused)}')
+    return reused
+
+def register(folder, stage_params):
+    """
+    处理完成后按当前的全部 content_keys 登记（此时视频已下载完，会同时登记 video: 指纹）。
+    只登记本次生成或复用、记录参数与 stage_params 一致的阶段，沿用的旧产物来源不明，不登记。
+    """
+    verified = verified_params(folder, stage_params)
+    if not verified:
+        return
+    for key in content_keys(folder):
+        metadata_cache.put_fingerprint(key, os.path.abspath(folder), verified)
@@ -3,7 +3,7 @@ from demucs.api import Separator
 import os
 from loguru import logger
 import time
-from .utils import save_wav, normalize_wav
+from .utils import save_wav, normalize_wav, get_duration, run_ffmpeg_progress, find_media_source
 import torch
 import gc
 
@@ -157,12 +157,12 @@ def separate_audio(folder: str, model_name: str = "htdemucs_ft", device: str = '
         raise
 
 
-def extract_audio_from_video(folder: str) -> bool:
+def extract_audio_from_video(folder: str, progress_callback=None) -> bool:
     """
-    从视频中提取音频
+    从视频（或先行下载的音轨 download_audio.*）中提取音频，progress_callback(百分比, 状态) 接收提取进度
     """
-    video_path = os.path.join(folder, 'download.mp4')
-    if not os.path.exists(video_path):
+    video_path = find_media_source(folder)
+    if video_path is None:
         return False
     audio_path = os.path.join(folder, 'audio.wav')
     if os.path.exists(audio_path):
@@ -170,28 +170,36 @@ def extract_audio_from_video(folder: str) -> bool:
         return True
     logger.info(f'正在从视频提取音频: {folder}')
 
-    os.system(
-        f'ffmpeg -loglevel error -i "{video_path}" -vn -acodec pcm_s16le -ar 44100 -ac 2 "{audio_path}"')
+    duration = get_duration(video_path) if progress_callback else None
 
-    time.sleep(1)
+    def report(out_time, fps, speed):
+        percent = min(out_time / duration * 100, 100) if duration else 0
+        progress_callback(percent, f'提取音频 {percent:.0f}% ({speed:.1f}x)')
+
+    success, stderr_output = run_ffmpeg_progress(
+        ['ffmpeg', '-loglevel', 'error', '-i', video_path, '-vn', '-acodec', 'pcm_s16le', '-ar', '44100', '-ac', '2', audio_path],
+        report if progress_callback else None, job='extract_audio')
+    if not success:
+        logger.error(f'音频提取失败: {stderr_output}')
+        return False
     logger.info(f'音频提取完成: {folder}')
     return True
 
 
 def separate_all_audio_under_folder(root_folder: str, model_name: str = "htdemucs_ft", device: str = 'auto',
-                                    progress: bool = True, shifts: int = 5) -> None:
+                                    progress: bool = True, shifts: int = 5, progress_callback=None) -> None:
     """
-    分离文件夹下所有音频
+    分离文件夹下所有音频，progress_callback 接收从视频提取音频的进度
     """
     global separator
     vocal_output_path, instruments_output_path = None, None
 
     try:
         for subdir, dirs, files in os.walk(root_folder):
-            if 'download.mp4' not in files:
+            if find_media_source(subdir) is None:
                 continue
             if 'audio.wav' not in files:
-                extract_audio_from_video(subdir)
+                extract_audio_from_video(subdir, progress_callback)
             if 'audio_vocals.wav' not in files:
                 vocal_output_path, instruments_output_path = separate_audio(subdir, model_name, device, progress,
                                                                             shifts)
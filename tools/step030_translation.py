@@ -7,14 +7,92 @@ from dotenv import load_dotenv
 import time
 from loguru import logger
 from tools.step031_translation_openai import openai_response
-from tools.step032_translation_llm import llm_response
-from tools.step033_translation_translator import translator_response
+from tools.step032_translation_llm import llm_response, llm_submit, get_tokenizer, llm_count_tokens
+from tools.step033_translation_translator import translator_response, translator_batch_iter
 from tools.step034_translation_ernie import ernie_response
 from tools.step035_translation_qwen import qwen_response
 from tools.step036_translation_ollama import ollama_response
 
 load_dotenv()
 import traceback
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 翻译时附带的历史对话的 token 预算（按目标模型的分词器计算），摘要在 system 消息中始终保留
+history_token_budget = int(os.getenv('TRANSLATION_HISTORY_TOKENS', 1024))
+tiktoken_encoding = None
+
+def count_tokens(text, method='LLM'):
+    global tiktoken_encoding
+    if method == 'LLM':
+        return len(get_tokenizer()(text).input_ids)
+    if tiktoken is not None:
+        if tiktoken_encoding is None:
+            tiktoken_encoding = tiktoken.get_encoding('cl100k_base')
+        return len(tiktoken_encoding.encode(text))
+    # 没有对应分词器时粗略估计：中日韩字符按 1 个 token，其余按 4 个字符 1 个 token
+    cjk = len(re.findall(r'[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]', text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def count_message_tokens(messages, method='LLM'):
+    if method == 'LLM':
+        return llm_count_tokens(messages)
+    # 每条消息额外计入角色等格式开销
+    return sum(count_tokens(message['content'], method) + 4 for message in messages)
+
+def select_history(history, method='LLM', budget=None):
+    """从最近的一轮往前取完整的问答对，直到超出 token 预算"""
+    if budget is None:
+        budget = history_token_budget
+    selected = []
+    used = 0
+    for i in range(len(history) - 2, -1, -2):
+        turn = history[i:i + 2]
+        tokens = sum(count_tokens(message['content'], method) + 4 for message in turn)
+        if used + tokens > budget:
+            break
+        selected = turn + selected
+        used += tokens
+    return selected
+
+# 本地模型(LLM)和Ollama支持约束解码，直接生成符合格式的输出，减少重试
+constrained_decoding = os.getenv('TRANSLATION_CONSTRAINED', '1') == '1'
+constrained_methods = ['LLM', 'Ollama']
+
+translation_schema = {
+    'type': 'object',
+    'properties': {'translation': {'type': 'string'}},
+    'required': ['translation'],
+}
+summary_schema = {
+    'type': 'object',
+    'properties': {'title': {'type': 'string'}, 'summary': {'type': 'string'}},
+    'required': ['title', 'summary'],
+}
+
+def constrained_translation_response(messages, method, target_language):
+    if method == 'LLM':
+        # 以少样本示例中的回答开头作为前缀，模型只续写译文，遇到右引号即结束
+        prefix = '翻译：“' if target_language == '简体中文' else 'Translated text: "'
+        return llm_submit(messages, prefix=prefix, stop=['”', '"'], banned=['\n']).result()
+    elif method == 'Ollama':
+        response = ollama_response(messages, format=translation_schema)
+        return json.loads(response)['translation']
+    raise Exception('Invalid method')
+
+def constrained_summary_response(messages, method):
+    if method == 'LLM':
+        prefix = '{"title": "'
+        title = llm_submit(messages, max_new_tokens=128, prefix=prefix, stop=['"'], banned=['\n']).result()
+        prefix += title + '", "summary": "'
+        summary = llm_submit(messages, max_new_tokens=512, prefix=prefix, stop=['"'], banned=['\n']).result()
+        return {'title': title, 'summary': summary}
+    elif method == 'Ollama':
+        response = ollama_response(messages, format=summary_schema)
+        return json.loads(response)
+    raise Exception('Invalid method')
 
 def get_necessary_info(info: dict):
     return {
@@ -53,6 +131,13 @@ def translation_postprocess(result):
     return result
 
 def valid_translation(text, translation):
+    success, translation = extract_translation(text, translation)
+    # 约束解码一开始就遇到右引号时得到空串，空译文会被配成静音，必须重试
+    if success and not translation.strip():
+        return False, 'The translation is empty. Only translate the following sentence and give me the result.'
+    return success, translation
+
+def extract_translation(text, translation):
     
     if (translation.startswith('```') and translation.endswith('```')):
         translation = translation[3:-3]
@@ -144,7 +229,7 @@ def split_sentences(translation, use_char_based_end=True):
 
     return output_data
 
-def summarize(info, transcript, target_language='简体中文', method = 'LLM'):
+def summarize(info, transcript, target_language='简体中文', method = 'LLM', stats=None):
     transcript = ' '.join(line['text'] for line in transcript)
     transcript = ensure_transcript_length(transcript, max_length=2000)
     info_message = f'Title: "{info["title"]}" Author: "{info["uploader"]}". ' 
@@ -174,26 +259,30 @@ def summarize(info, transcript, target_language='简体中文', method = 'LLM'):
                 {'role': 'system', 'content': f'You are a expert in the field of this video. Please summarize the video in JSON format.\n```json\n{{"title": "the title of the video", "summary", "the summary of the video"}}\n```'},
                 {'role': 'user', 'content': full_description+retry_message},
             ]
-            if method == 'LLM':
-                response = llm_response(messages)
-            elif method == 'OpenAI':
-                response = openai_response(messages)
-            elif method == 'Ernie':
-                system_content = messages[0]['content']
-                user_messages = messages[1:]
-                response = ernie_response(user_messages, system=system_content)
-            elif method == '阿里云-通义千问':
-                response = qwen_response(messages)
-            elif method == 'Ollama':  # 添加对Ollama的支持
-                response = ollama_response(messages)
+            if constrained_decoding and method in constrained_methods:
+                summary = constrained_summary_response(messages, method)
+                logger.info(summary)
             else:
-                raise Exception('Invalid method')
-            summary = response.replace('\n', '')
-            if '视频标题' in summary:
+                if method == 'LLM':
+                    response = llm_response(messages)
+                elif method == 'OpenAI':
+                    response = openai_response(messages)
+                elif method == 'Ernie':
+                    system_content = messages[0]['content']
+                    user_messages = messages[1:]
+                    response = ernie_response(user_messages, system=system_content)
+                elif method == '阿里云-通义千问':
+                    response = qwen_response(messages)
+                elif method == 'Ollama':  # 添加对Ollama的支持
+                    response = ollama_response(messages)
+                else:
+                    raise Exception('Invalid method')
+                summary = response.replace('\n', '')
+                logger.info(summary)
+                summary = re.findall(r'\{.*?\}', summary)[0]
+                summary = json.loads(summary)
+            if '视频标题' in summary['title'] + summary['summary']:
                 raise Exception("包含“视频标题”")
-            logger.info(summary)
-            summary = re.findall(r'\{.*?\}', summary)[0]
-            summary = json.loads(summary)
             summary = {
                 'title': summary['title'].replace('title:', '').strip(),
                 'summary': summary['summary'].replace('summary:', '').strip()
@@ -210,6 +299,8 @@ def summarize(info, transcript, target_language='简体中文', method = 'LLM'):
             retry_message += '\nSummarize the video in JSON format:\n```json\n{"title": "", "summary": ""}\n```'
             logger.warning(f'总结失败\n{e}')
             time.sleep(1)
+    if stats is not None:
+        stats['summary_retries'] = retry
             
     if not success:
         raise Exception(f'总结失败')
@@ -240,10 +331,46 @@ def summarize(info, transcript, target_language='简体中文', method = 'LLM'):
             logger.warning(f'总结翻译失败\n{e}')
             time.sleep(1)
 
-def _translate(summary, transcript, target_language='简体中文', method='LLM'):
+def load_translation_journal(journal_path, transcript, target_language, method):
+    """
+    读取逐行追加的翻译日志，返回可以复用的已翻译行。
+    第一行记录翻译方式和目标语言，不一致时整份日志作废；
+    之后每行一条记录，遇到行号或原文对不上、或者写了一半的记录就停止。
+    """
+    if journal_path is None or not os.path.exists(journal_path):
+        return []
+    with open(journal_path, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    try:
+        header = json.loads(lines[0])
+    except (IndexError, json.JSONDecodeError):
+        return []
+    if header.get('method') != method or header.get('target_language') != target_language:
+        logger.info(f'翻译日志的参数与当前不一致，重新翻译: {journal_path}')
+        return []
+    translations = []
+    for line in lines[1:]:
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            break
+        index = len(translations)
+        if index >= len(transcript) or record.get('index') != index or record.get('text') != transcript[index]['text']:
+            break
+        translations.append(record['translation'])
+    return translations
+
+def _translate(summary, transcript, target_language='简体中文', method='LLM', stats=None, journal_path=None):
+    if stats is None:
+        stats = {}
+    stats.setdefault('translation_retries', 0)
+    stats.setdefault('retried_lines', 0)
+    stats.setdefault('failed_lines', 0)
+    stats.setdefault('prompt_calls', 0)
+    stats.setdefault('prompt_tokens', 0)
+    stats.setdefault('max_prompt_tokens', 0)
 
     info = f'This is a video called "{summary["title"]}". {summary["summary"]}.'
-    full_translation = []
     if target_language == '简体中文':
         fixed_message = [
             {'role': 'system', 'content': f'You are an expert in the field of this video.\n{info}\nTranslate the sentence into {target_language}. 下面我让你来充当翻译家，你的目标是把任何语言翻译成{target_language}，请翻译时不要带翻译腔，而是要翻译得自然、流畅和地道，使用优美和高雅的表达方式。请将人工智能的“agent”翻译为“智能体”，强化学习中是`Q-Learning`而不是`Queue Learning`。数学公式写成plain text，不要使用latex。确保翻译正确和简洁。注意信达雅。'},
@@ -263,23 +390,62 @@ def _translate(summary, transcript, target_language='简体中文', method='LLM'
         ]
 
     history = []
+    # 从翻译日志恢复已完成的行和对应的历史对话
+    full_translation = load_translation_journal(journal_path, transcript, target_language, method)
+    for line, translation in zip(transcript, full_translation):
+        history.append({'role': 'user', 'content': f'Translate:"{line["text"]}"'})
+        history.append({'role': 'assistant', 'content': f'翻译：“{translation}”'})
+    resumed = len(full_translation)
+    if resumed:
+        logger.info(f'从翻译日志恢复 {resumed}/{len(transcript)} 行')
+    journal = None
+    if journal_path is not None:
+        # 重写日志只保留有效记录，之后逐行追加
+        journal = open(journal_path, 'w', encoding='utf-8')
+        journal.write(json.dumps({'method': method, 'target_language': target_language}, ensure_ascii=False) + '\n')
+        for i, translation in enumerate(full_translation):
+            journal.write(json.dumps({'index': i, 'text': transcript[i]['text'], 'translation': translation}, ensure_ascii=False) + '\n')
+        journal.flush()
+
+    if method in ['Google Translate', 'Bing Translate']:
+        # 机器翻译接口把多行打包成一次请求，逐包取回，每包返回后各行立即写入日志
+        translator_server = 'google' if method == 'Google Translate' else 'bing'
+        batch_translation = translator_batch_iter(
+            [line['text'] for line in transcript[resumed:]], to_language=target_language, translator_server=translator_server)
     
-    for line in transcript:
+    for i, line in enumerate(transcript):
+        if i < resumed:
+            continue
         text = line['text']
 
         retry_message = 'Only translate the quoted sentence and give me the final translation.'
-        if method == 'Google Translate':
-            translation = translator_response(text, to_language = target_language, translator_server='google')
-        elif method == 'Bing Translate':
-            translation = translator_response(text, to_language = target_language, translator_server='bing')
+        if method in ['Google Translate', 'Bing Translate']:
+            _, translation = next(batch_translation)
+            if not translation or not translation.strip():
+                # 失败时接口返回空字符串，单独再请求一次这一行，仍失败则保留原文，不中断整个视频
+                logger.warning(f'机器翻译结果为空，单独翻译: {text}')
+                translation = translator_response(text, to_language=target_language, translator_server=translator_server)
+            if not translation or not translation.strip():
+                logger.warning(f'机器翻译失败，保留原文: {text}')
+                translation = text
+                stats['failed_lines'] += 1
         else:
+            context = select_history(history, method)
+            last_response = None
             for retry in range(10):
                 messages = fixed_message + \
-                    history[-30:] + [{'role': 'user',
-                                    'content': f'Translate:"{text}"'}]
+                    context + [{'role': 'user',
+                                'content': f'Translate:"{text}"'}]
+                prompt_tokens = count_message_tokens(messages, method)
+                logger.info(f'Prompt tokens: {prompt_tokens} (history {len(context) // 2} turns)')
+                stats['prompt_calls'] += 1
+                stats['prompt_tokens'] += prompt_tokens
+                stats['max_prompt_tokens'] = max(stats['max_prompt_tokens'], prompt_tokens)
                 # print(messages)
                 try:
-                    if method == 'LLM':
+                    if constrained_decoding and method in constrained_methods:
+                        response = constrained_translation_response(messages, method, target_language)
+                    elif method == 'LLM':
                         response = llm_response(messages)
                     elif method == 'OpenAI':
                         response = openai_response(messages)
@@ -294,6 +460,7 @@ def _translate(summary, transcript, target_language='简体中文', method='LLM'
                     else:
                         raise Exception('Invalid method')
                     translation = response.replace('\n', '')
+                    last_response = translation
                     logger.info(f'原文：{text}')
                     logger.info(f'译文：{translation}')
                     success, translation = valid_translation(text, translation)
@@ -305,10 +472,28 @@ def _translate(summary, transcript, target_language='简体中文', method='LLM'
                     logger.error(e)
                     logger.warning('翻译失败')
                     time.sleep(1)
+            else:
+                # 重试用尽仍没有有效译文时沿用最后一次的回复，没有回复则保留原文，照常写入日志，不中断整个视频
+                if last_response and last_response.strip():
+                    translation = translation_postprocess(last_response.strip())
+                    logger.warning(f'翻译失败，已重试 {retry + 1} 次，沿用最后一次回复: {text}')
+                else:
+                    translation = text
+                    logger.warning(f'翻译失败，已重试 {retry + 1} 次，保留原文: {text}')
+                stats['failed_lines'] += 1
+            if retry > 0:
+                stats['translation_retries'] += retry
+                stats['retried_lines'] += 1
         full_translation.append(translation)
+        if journal is not None:
+            journal.write(json.dumps({'index': i, 'text': text, 'translation': translation}, ensure_ascii=False) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
         history.append({'role': 'user', 'content': f'Translate:"{text}"'})
         history.append({'role': 'assistant', 'content': f'翻译：“{translation}”'})
         time.sleep(0.1)
+    if journal is not None:
+        journal.close()
         
     return full_translation
 
@@ -335,11 +520,13 @@ def translate(method, folder, target_language='简体中文'):
     with open(transcript_path, 'r', encoding='utf-8') as f:
         transcript = json.load(f)
     
+    # 记录每个视频的重试次数，便于评估约束解码的效果
+    stats = {'method': method, 'constrained': constrained_decoding and method in constrained_methods}
     summary_path = os.path.join(folder, 'summary.json')
     if os.path.exists(summary_path):
         summary = json.load(open(summary_path, 'r', encoding='utf-8'))
     else:
-        summary = summarize(info, transcript, target_language, method)
+        summary = summarize(info, transcript, target_language, method, stats)
         if summary is None:
             logger.error(f'Failed to summarize {folder}')
             return False
@@ -347,12 +534,19 @@ def translate(method, folder, target_language='简体中文'):
             json.dump(summary, f, indent=2, ensure_ascii=False)
 
     translation_path = os.path.join(folder, 'translation.json')
-    translation = _translate(summary, transcript, target_language, method)
+    journal_path = os.path.join(folder, 'translation_journal.jsonl')
+    translation = _translate(summary, transcript, target_language, method, stats, journal_path)
     for i, line in enumerate(transcript):
         line['translation'] = translation[i]
     transcript = split_sentences(transcript)
-    with open(translation_path, 'w', encoding='utf-8') as f:
+    # 全部翻译完成后才生成 translation.json，先写临时文件再替换
+    with open(translation_path + '.tmp', 'w', encoding='utf-8') as f:
         json.dump(transcript, f, indent=2, ensure_ascii=False)
+    os.replace(translation_path + '.tmp', translation_path)
+    os.remove(journal_path)
+    logger.info(f'翻译重试统计: {stats}')
+    with open(os.path.join(folder, 'translation_stats.json'), 'w', encoding='utf-8') as f:
+        json.dump(stats, f, indent=2, ensure_ascii=False)
     return summary, transcript
 
 def translate_all_transcript_under_folder(folder, method, target_language):
@@ -2,6 +2,9 @@
 import json
 import os
 import re
+import queue
+import threading
+from concurrent.futures import Future
 import torch
 from dotenv import load_dotenv
 import time
@@ -11,51 +14,351 @@ load_dotenv()
 
 model = None
 tokenizer = None
+engine = None
+# 模型、引擎和分词器都是首次使用时才创建，多个翻译线程可能同时触发，加锁保证只创建一次
+engine_lock = threading.Lock()
+tokenizer_lock = threading.Lock()
 model_name = os.getenv('MODEL_NAME', 'qwen/Qwen1.5-4B-Chat')
 if 'Qwen' not in model_name:
     model_name = 'qwen/Qwen1.5-4B-Chat'
+# 同时参与解码的最大序列数
+max_batch_size = int(os.getenv('LLM_MAX_BATCH_SIZE', 8))
+
+def get_pretrained_path(model_name):
+    model_path = os.path.join('models/LLM', os.path.basename(model_name))
+    return model_name if not os.path.isdir(model_path) else model_path
 
 def init_llm_model(model_name):
     global model, tokenizer
     if 'Qwen' in model_name:
-        from transformers import AutoModelForCausalLM, AutoTokenizer
-        model_path = os.path.join('models/LLM', os.path.basename(model_name))
-        pretrained_path = model_name if not os.path.isdir(model_path) else model_path
-        
+        from transformers import AutoModelForCausalLM
+        pretrained_path = get_pretrained_path(model_name)
+
         model = AutoModelForCausalLM.from_pretrained(
             pretrained_path,
             torch_dtype="auto",
             device_map="auto"
         )
-        tokenizer = AutoTokenizer.from_pretrained(pretrained_path)
+        tokenizer = get_tokenizer()
         print('Finish Load model', pretrained_path)
 
-def llm_response(messages, device='auto'):
-    if model is None:
-        init_llm_model(model_name)
-    if 'Qwen' in model_name:
-        text = tokenizer.apply_chat_template(
+
+def _to_legacy_cache(past_key_values):
+    # 新版本 transformers 返回 Cache 对象，这里统一转成 ((k, v), ...) 形式便于按行拼接和裁剪
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+class _Sequence:
+    def __init__(self, prompt_ids, max_new_tokens, future, stop=None, banned_mask=None):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.future = future
+        self.stop = stop or []
+        # 检查 stop 时只解码末尾若干 token，足以覆盖最长的 stop 字符串（每个 token 至少一个字节）
+        self.stop_window = 4 * max(len(s) for s in self.stop) + 2 if self.stop else 0
+        self.banned_mask = banned_mask
+        self.generated = []
+
+
+class ContinuousBatchingEngine:
+    """
+    进程内的连续批处理生成引擎。
+
+    多个调用方（线程、多个视频的翻译循环）通过 submit 提交对话并拿到 Future。
+    后台线程把请求动态组成一个批次，左侧填充并用 attention_mask 屏蔽填充位置；
+    每个解码步之前接纳新请求（单独 prefill 后把 KV cache 拼进批次），
+    每个解码步之后把遇到 EOS 或达到各自 max_new_tokens 的序列移出批次。
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size=8, max_new_tokens=512):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.requests = queue.Queue()
+        # 禁用 token 的掩码按 banned 缓存，直接建在模型所在设备上，采样时不再逐步创建和拷贝
+        self.vocab_size = getattr(model.config, 'vocab_size', None) or len(tokenizer)
+        self.banned_cache = {}
+        self.banned_lock = threading.Lock()
+        self.no_banned_mask = torch.zeros(self.vocab_size, dtype=torch.bool, device=model.device)
+
+        generation_config = model.generation_config
+        eos_token_id = generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = tokenizer.eos_token_id
+        if not isinstance(eos_token_id, (list, tuple)):
+            eos_token_id = [eos_token_id]
+        self.eos_token_ids = set(eos_token_id)
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else list(self.eos_token_ids)[0]
+        self.do_sample = bool(getattr(generation_config, 'do_sample', False))
+        self.temperature = getattr(generation_config, 'temperature', None) or 1.0
+        self.top_p = getattr(generation_config, 'top_p', None) or 1.0
+        self.top_k = getattr(generation_config, 'top_k', None) or 0
+        self.repetition_penalty = getattr(generation_config, 'repetition_penalty', None) or 1.0
+
+        self._reset()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def _reset(self):
+        self.active = []
+        self.past_key_values = None
+        self.attention_mask = None
+        self.position_ids = None
+        self.next_tokens = None
+
+    def estimate_max_new_tokens(self, messages):
+        # 按最后一条 user 消息的长度估计输出长度，避免每句翻译都预留 512 个 token
+        source = ''
+        for message in reversed(messages):
+            if message['role'] == 'user':
+                source = message['content']
+                break
+        num_tokens = len(self.tokenizer(source).input_ids)
+        return min(self.max_new_tokens, max(64, 2 * num_tokens + 32))
+
+    def banned_token_mask(self, banned):
+        # 词表中解码后包含任一禁用子串的 token，每组 banned 只计算一次；submit 会在多个线程中调用
+        key = tuple(banned)
+        with self.banned_lock:
+            if key not in self.banned_cache:
+                ids = [i for i in range(min(len(self.tokenizer), self.vocab_size))
+                       if i not in self.eos_token_ids and any(b in self.tokenizer.decode([i]) for b in banned)]
+                mask = torch.zeros(self.vocab_size, dtype=torch.bool)
+                mask[ids] = True
+                self.banned_cache[key] = mask.to(self.model.device)
+            return self.banned_cache[key]
+
+    def submit(self, messages, max_new_tokens=None, prefix='', stop=None, banned=None):
+        """
+        提交一次生成请求。
+
+        prefix 会直接接在 assistant 回复的开头，模型只需续写；
+        生成文本中出现 stop 中任一字符串即结束，并截断到该位置；
+        banned 中的子串（如换行）对应的 token 在采样时被屏蔽。
+        """
+        future = Future()
+        if max_new_tokens is None:
+            max_new_tokens = self.estimate_max_new_tokens(messages)
+        text = self.tokenizer.apply_chat_template(
             messages,
             tokenize=False,
             add_generation_prompt=True
         )
-        if device == 'auto':
-            device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        model_inputs = tokenizer([text], return_tensors="pt").to(device)
+        prompt_ids = self.tokenizer(text + prefix).input_ids
+        banned_mask = self.banned_token_mask(banned) if banned else None
+        self.requests.put(_Sequence(prompt_ids, max_new_tokens, future, stop, banned_mask))
+        return future
+
+    def _loop(self):
+        while True:
+            new_sequences = []
+            if not self.active:
+                # 没有正在解码的序列时阻塞等待新请求
+                new_sequences.append(self.requests.get())
+            while len(self.active) + len(new_sequences) < self.max_batch_size:
+                try:
+                    new_sequences.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            new_sequences = [seq for seq in new_sequences if seq.future.set_running_or_notify_cancel()]
+            try:
+                with torch.inference_mode():
+                    if new_sequences:
+                        self._admit(new_sequences)
+                    if self.active:
+                        self._step()
+            except Exception as e:
+                logger.error(f'LLM批处理生成失败: {e}')
+                for seq in self.active + new_sequences:
+                    if not seq.future.done():
+                        seq.future.set_exception(e)
+                self._reset()
 
-        generated_ids = model.generate(
-            model_inputs.input_ids,
-            max_new_tokens=512
+    def _admit(self, sequences):
+        device = self.model.device
+        max_len = max(len(seq.prompt_ids) for seq in sequences)
+        input_ids = torch.full((len(sequences), max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(sequences), max_len), dtype=torch.long)
+        for row, seq in enumerate(sequences):
+            input_ids[row, max_len - len(seq.prompt_ids):] = torch.tensor(seq.prompt_ids)
+            attention_mask[row, max_len - len(seq.prompt_ids):] = 1
+        input_ids = input_ids.to(device)
+        attention_mask = attention_mask.to(device)
+        position_ids = attention_mask.cumsum(-1) - 1
+        position_ids.masked_fill_(attention_mask == 0, 1)
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
         )
-        generated_ids = [
-            output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-        ]
+        past_key_values = _to_legacy_cache(outputs.past_key_values)
+        next_positions = attention_mask.sum(-1)
+
+        if self.active:
+            # 新旧两批的 KV cache 长度不同，短的一方在左侧补零并屏蔽
+            old_len = self.attention_mask.shape[1]
+            new_len = attention_mask.shape[1]
+            total = max(old_len, new_len)
+            self.past_key_values = tuple(
+                tuple(
+                    torch.cat([self._left_pad(old, total - old_len), self._left_pad(new, total - new_len)], dim=0)
+                    for old, new in zip(old_layer, new_layer)
+                )
+                for old_layer, new_layer in zip(self.past_key_values, past_key_values)
+            )
+            self.attention_mask = torch.cat([
+                torch.nn.functional.pad(self.attention_mask, (total - old_len, 0)),
+                torch.nn.functional.pad(attention_mask, (total - new_len, 0)),
+            ], dim=0)
+            self.position_ids = torch.cat([self.position_ids, next_positions], dim=0)
+        else:
+            self.past_key_values = past_key_values
+            self.attention_mask = attention_mask
+            self.position_ids = next_positions
 
-        response = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-        return response
+        next_tokens = self._sample(outputs.logits[:, -1, :], sequences)
+        self.next_tokens = next_tokens if not self.active else torch.cat([self.next_tokens, next_tokens], dim=0)
+        self.active.extend(sequences)
+        self._retire()
+
+    @staticmethod
+    def _left_pad(tensor, pad):
+        if pad == 0:
+            return tensor
+        shape = list(tensor.shape)
+        shape[2] = pad
+        return torch.cat([tensor.new_zeros(shape), tensor], dim=2)
+
+    def _step(self):
+        device = self.model.device
+        self.attention_mask = torch.cat([
+            self.attention_mask,
+            self.attention_mask.new_ones((self.attention_mask.shape[0], 1))
+        ], dim=1)
+        outputs = self.model(
+            input_ids=self.next_tokens.unsqueeze(-1).to(device),
+            attention_mask=self.attention_mask,
+            position_ids=self.position_ids.unsqueeze(-1),
+            past_key_values=self.past_key_values,
+            use_cache=True,
+        )
+        self.past_key_values = _to_legacy_cache(outputs.past_key_values)
+        self.position_ids = self.position_ids + 1
+        self.next_tokens = self._sample(outputs.logits[:, -1, :], self.active)
+        self._retire()
+
+    def _sample(self, logits, sequences):
+        logits = logits.float()
+        if self.repetition_penalty != 1.0:
+            for row, seq in enumerate(sequences):
+                seen = torch.tensor(seq.prompt_ids + seq.generated, device=logits.device).unique()
+                score = logits[row, seen]
+                logits[row, seen] = torch.where(score < 0, score * self.repetition_penalty, score / self.repetition_penalty)
+        if any(seq.banned_mask is not None for seq in sequences):
+            banned_mask = torch.stack([self.no_banned_mask if seq.banned_mask is None else seq.banned_mask for seq in sequences])
+            logits[:, :self.vocab_size].masked_fill_(banned_mask.to(logits.device), float('-inf'))
+        if self.do_sample:
+            logits = logits / max(self.temperature, 1e-5)
+            if self.top_k > 0:
+                kth = torch.topk(logits, min(self.top_k, logits.shape[-1]), dim=-1).values[:, -1:]
+                logits = logits.masked_fill(logits < kth, float('-inf'))
+            if self.top_p < 1.0:
+                sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+                cumulative = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+                remove = cumulative - sorted_logits.softmax(dim=-1) > self.top_p
+                sorted_logits = sorted_logits.masked_fill(remove, float('-inf'))
+                logits = torch.full_like(logits, float('-inf')).scatter(-1, sorted_indices, sorted_logits)
+            next_tokens = torch.multinomial(logits.softmax(dim=-1), num_samples=1).squeeze(-1)
+        else:
+            next_tokens = logits.argmax(dim=-1)
+        # 逐行追加本步选出的 token
+        for seq, token in zip(sequences, next_tokens.tolist()):
+            seq.generated.append(token)
+        return next_tokens
+
+    def _finished(self, seq):
+        if seq.generated[-1] in self.eos_token_ids or len(seq.generated) >= seq.max_new_tokens:
+            return True
+        if seq.stop:
+            text = self.tokenizer.decode(seq.generated[-seq.stop_window:], skip_special_tokens=True)
+            return any(s in text for s in seq.stop)
+        return False
+
+    def _result(self, seq):
+        tokens = [token for token in seq.generated if token not in self.eos_token_ids]
+        text = self.tokenizer.decode(tokens, skip_special_tokens=True)
+        for s in seq.stop:
+            text = text.split(s)[0]
+        return text
+
+    def _retire(self):
+        keep = []
+        for row, seq in enumerate(self.active):
+            if not self._finished(seq):
+                keep.append(row)
+                continue
+            seq.future.set_result(self._result(seq))
+        if len(keep) == len(self.active):
+            return
+        if not keep:
+            self._reset()
+            return
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        self.active = [self.active[row] for row in keep]
+        self.attention_mask = self.attention_mask.index_select(0, index)
+        # 去掉所有剩余序列都不再需要的左侧填充列
+        offset = int(self.attention_mask.any(dim=0).nonzero()[0])
+        self.attention_mask = self.attention_mask[:, offset:]
+        self.past_key_values = tuple(
+            tuple(state.index_select(0, index.to(state.device))[:, :, offset:] for state in layer)
+            for layer in self.past_key_values
+        )
+        self.position_ids = self.position_ids.index_select(0, index)
+        self.next_tokens = self.next_tokens.index_select(0, index.to(self.next_tokens.device))
+
+
+def get_engine():
+    global engine
+    with engine_lock:
+        if model is None:
+            init_llm_model(model_name)
+        if engine is None:
+            engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=max_batch_size)
+    return engine
+
+
+def get_tokenizer():
+    # 只需要计数时不加载模型权重
+    global tokenizer
+    with tokenizer_lock:
+        if tokenizer is None:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(get_pretrained_path(model_name))
+    return tokenizer
+
+
+def llm_count_tokens(messages):
+    """按本地模型的对话模板计算 prompt 的 token 数"""
+    text = get_tokenizer().apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return len(get_tokenizer()(text).input_ids)
+
+
+def llm_submit(messages, max_new_tokens=None, prefix='', stop=None, banned=None):
+    """提交一次生成请求，立即返回 Future，结果为生成的文本"""
+    return get_engine().submit(messages, max_new_tokens=max_new_tokens, prefix=prefix, stop=stop, banned=banned)
+
+
+def llm_response(messages, device='auto'):
+    if 'Qwen' in model_name:
+        return llm_submit(messages).result()
     return ''
 
 if __name__ == '__main__':
     test_message = [{"role": "user", "content": "你好，介绍一下你自己"}]
     response = llm_response(test_message)
-    print(response)
\ No newline at end of file
+    print(response)
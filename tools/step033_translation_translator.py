@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import json
 import os
+import re
 import translators as ts
 from dotenv import load_dotenv
 from loguru import logger
@@ -21,6 +22,56 @@ def translator_response(messages, to_language = 'zh-CN', translator_server = 'bi
             print('tranlate failed!')
     return translation
 
+# 各翻译服务单次请求的字符上限，留出编号分隔符的余量
+translator_char_limits = {
+    'google': 4500,
+    'bing': 900,
+}
+
+def pack_lines(lines, max_chars):
+    """把多行文本按字符上限打包，每包为 [(行号, 文本), ...]"""
+    chunks = []
+    chunk = []
+    size = 0
+    for i, text in enumerate(lines):
+        length = len(text) + 8
+        if chunk and size + length > max_chars:
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+        chunk.append((i, text))
+        size += length
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def split_numbered_lines(translation, num_lines):
+    """按 [编号] 拆回各行，编号必须是 0..num_lines-1 且顺序一致，否则返回 None"""
+    parts = re.split(r'(?:^|\n)\s*[\[【](\d+)[\]】]\s*', translation)
+    if parts[0].strip():
+        return None
+    indices = [int(index) for index in parts[1::2]]
+    if indices != list(range(num_lines)):
+        return None
+    return [text.strip() for text in parts[2::2]]
+
+def translator_batch_iter(lines, to_language = 'zh-CN', translator_server = 'bing'):
+    """
+    把多行文本打包成带编号的请求逐包翻译，拆分后校验行数和编号；某个包校验失败时只对该包逐行翻译。
+    每翻译完一包就按顺序产出该包各行的 (行号, 译文)，调用方可以边翻译边保存。
+    """
+    max_chars = translator_char_limits.get(translator_server, 900)
+    chunks = pack_lines([text.replace('\n', ' ') for text in lines], max_chars)
+    for chunk in chunks:
+        query = '\n'.join(f'[{j}] {text}' for j, (_, text) in enumerate(chunk))
+        result = split_numbered_lines(translator_response(query, to_language, translator_server), len(chunk))
+        if result is None:
+            logger.warning(f'批量翻译结果无法按行拆分，逐行翻译 {len(chunk)} 行')
+            result = [translator_response(text, to_language, translator_server) for _, text in chunk]
+        for (i, _), translation in zip(chunk, result):
+            yield i, translation
+    logger.info(f'批量翻译 {len(lines)} 行，共 {len(chunks)} 次请求')
+
 if __name__ == '__main__':
     response = translator_response('Hello, how are you?', '中文', 'bing')
     print(response)
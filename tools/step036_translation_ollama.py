@@ -8,13 +8,14 @@ from loguru import logger
 load_dotenv()
 
 
-def ollama_response(messages, model_name=None):
+def ollama_response(messages, model_name=None, format=None):
     """
     使用Ollama API进行翻译处理
 
     参数:
         messages: 与OpenAI格式兼容的消息列表
         model_name: Ollama模型名称，如果为None则从环境变量获取
+        format: 约束输出格式，'json' 或 JSON Schema，由Ollama在解码时强制输出符合该格式
 
     返回:
         翻译结果文本
@@ -31,6 +32,8 @@ def ollama_response(messages, model_name=None):
         "messages": messages,
         "stream": False
     }
+    if format is not None:
+        payload["format"] = format
 
     try:
         logger.info(f"正在使用Ollama模型 {model_name} 进行翻译...")
@@ -1,18 +1,22 @@
 import json
 import os
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import librosa
+import torch
 
 from loguru import logger
 import numpy as np
 
-from .utils import save_wav, save_wav_norm
+from .utils import save_wav, save_wav_norm, time_stretch
 # from .step041_tts_bytedance import tts as bytedance_tts
-from .step042_tts_xtts import tts as xtts_tts
-from .step043_tts_cosyvoice import tts as cosyvoice_tts
-from .step044_tts_edge_tts import tts as edge_tts
+from .step042_tts_xtts import tts as xtts_tts, tts_batch as xtts_tts_batch, get_cpu_executor as xtts_cpu_executor, reset_cpu_executor as xtts_reset_cpu_executor, cache_settings as xtts_cache_settings
+from .step043_tts_cosyvoice import tts as cosyvoice_tts, cache_settings as cosyvoice_cache_settings
+from .step044_tts_edge_tts import tts as edge_tts, tts_batch as edge_tts_batch, cache_settings as edge_tts_cache_settings
 from .cn_tx import TextNorm
-from audiostretchy.stretch import stretch_audio
+from . import tts_cache
 normalizer = TextNorm()
 def preprocess_text(text):
     text = text.replace('AI', '人工智能')
@@ -23,24 +27,62 @@ def preprocess_text(text):
     return text
     
     
-def adjust_audio_length(wav_path, desired_length, sample_rate = 24000, min_speed_factor = 0.6, max_speed_factor = 1.1):
-    try:
-        wav, sample_rate = librosa.load(wav_path, sr=sample_rate)
-    except Exception as e:
-        if wav_path.endswith('.wav'):
-            wav_path = wav_path.replace('.wav', '.mp3')
-        wav, sample_rate = librosa.load(wav_path, sr=sample_rate)
+# 合成池的 worker 数，0 表示按引擎自动选择
+tts_workers = int(os.getenv('TTS_WORKERS', 0))
+
+# 引擎已按目标时长合成，剩余偏差小于该比例时不再做时间伸缩
+stretch_tolerance = float(os.getenv('TTS_STRETCH_TOLERANCE', 0.03))
+
+# 各语言的初始语速估计（字符/秒），合成过程中按实际时长滑动更新
+default_chars_per_second = {
+    '中文': 4.5,
+    '粤语': 4.5,
+    'Japanese': 7.0,
+    'Korean': 6.0,
+}
+
+def estimate_speed(text, slot, chars_per_second, min_speed_factor = 0.6, max_speed_factor = 1.1):
+    """按当前语速估计让引擎直接合成到 slot 秒所需的语速倍率，范围与 adjust_audio_length 一致"""
+    if slot <= 0 or not text:
+        return 1.0
+    natural_length = len(text) / chars_per_second
+    speed = max(min(natural_length / slot, 1 / min_speed_factor), 1 / max_speed_factor)
+    # 量化到 0.05，相同文本在不同视频里更容易命中片段缓存
+    return round(speed * 20) / 20
+
+def engine_settings(method):
+    """引擎的模型标识和生成参数，换模型或改参数后不会命中旧的缓存片段"""
+    if method == 'xtts':
+        return xtts_cache_settings()
+    if method == 'cosyvoice':
+        return cosyvoice_cache_settings()
+    if method == 'EdgeTTS':
+        return edge_tts_cache_settings()
+    return {}
+
+def clip_key(method, text, target_language, voice, speaker_wav, speed):
+    settings = {'speed': speed, **engine_settings(method)}
+    if method == 'EdgeTTS':
+        return tts_cache.clip_key(text, method, target_language, voice=voice, settings=settings)
+    return tts_cache.clip_key(text, method, target_language, speaker_wav=speaker_wav, settings=settings)
+
+def fetch_cached_clip(key, old_key, output_path):
+    """wavs 下的旧文件与当前译文不符时删除，再尝试从片段缓存取回，返回是否命中"""
+    if old_key is not None and old_key != key and os.path.exists(output_path):
+        os.remove(output_path)
+    if os.path.exists(output_path):
+        return False
+    return tts_cache.fetch(key, output_path)
+
+def adjust_audio_length(wav, desired_length, sample_rate = 24000, min_speed_factor = 0.6, max_speed_factor = 1.1):
     current_length = len(wav)/sample_rate
     speed_factor = max(
         min(desired_length / current_length, max_speed_factor), min_speed_factor)
     logger.info(f"Speed Factor {speed_factor}")
+    if abs(speed_factor - 1) < stretch_tolerance:
+        return wav, current_length
     desired_length = current_length * speed_factor
-    if wav_path.endswith('.wav'):
-        target_path = wav_path.replace('.wav', f'_adjusted.wav')
-    elif wav_path.endswith('.mp3'):
-        target_path = wav_path.replace('.mp3', f'_adjusted.wav')
-    stretch_audio(wav_path, target_path, ratio=speed_factor, sample_rate=sample_rate)
-    wav, sample_rate = librosa.load(target_path, sr=sample_rate)
+    wav = time_stretch(wav, speed_factor, sample_rate=sample_rate)
     return wav[:int(desired_length*sample_rate)], desired_length
 
 tts_support_languages = {
@@ -53,6 +95,34 @@ tts_support_languages = {
     'cosyvoice': ['中文', '粤语', 'English', 'Japanese', 'Korean', 'French'], 
 }
 
+def synthesize_line(method, text, output_path, speaker_wav, target_language='中文', voice='zh-CN-XiaoxiaoNeural', speed=1.0, sample_rate=24000):
+    """合成一句（已存在的文件直接读取），返回 sample_rate 下的波形"""
+    if method == 'bytedance':
+        bytedance_tts(text, output_path, speaker_wav, target_language = target_language)
+    elif method == 'xtts':
+        xtts_tts(text, output_path, speaker_wav, target_language = target_language, speed = speed)
+    elif method == 'cosyvoice':
+        cosyvoice_tts(text, output_path, speaker_wav, target_language = target_language, speed = speed)
+    elif method == 'EdgeTTS':
+        edge_tts(text, output_path, target_language = target_language, voice = voice, speed = speed)
+    wav, _ = librosa.load(output_path, sr=sample_rate)
+    return wav
+
+def get_executor(method, speaker_wav=None, target_language='中文'):
+    """
+    按引擎选择合成池，返回 (池, worker 数, 用完后是否关闭)：
+    CPU 上的 XTTS 用常驻的多进程池（每个进程绑定一组核心并各自加载模型），
+    其余引擎用线程池；GPU 上的模型只有一份，线程数为 1 以免争用显存。
+    """
+    if method == 'xtts' and not torch.cuda.is_available():
+        executor, workers = xtts_cpu_executor(speaker_wav, target_language)
+        return executor, workers, False
+    if method == 'EdgeTTS':
+        workers = tts_workers or 8
+    else:
+        workers = tts_workers or 1
+    return ThreadPoolExecutor(workers), workers, True
+
 def generate_wavs(method, folder, target_language='中文', voice = 'zh-CN-XiaoxiaoNeural'):
     assert method in ['xtts', 'bytedance', 'cosyvoice', 'EdgeTTS']
     transcript_path = os.path.join(folder, 'translation.json')
@@ -71,40 +141,123 @@ def generate_wavs(method, folder, target_language='中文', voice = 'zh-CN-Xiaox
     if target_language not in tts_support_languages[method]:
         logger.error(f'{method} does not support {target_language}')
         return f'{method} does not support {target_language}'
+
+    # 每句的目标语速：批量合成的引擎用初始语速估计，其余引擎按批提交，每批合成完按实际时长更新估计
+    chars_per_second = default_chars_per_second.get(target_language, 14.0)
+    texts = [preprocess_text(line['translation']) for line in transcript]
+    speeds = [None] * len(transcript)
+    if method in ['xtts', 'EdgeTTS']:
+        speeds = [estimate_speed(text, line['end'] - line['start'], chars_per_second) for text, line in zip(texts, transcript)]
+
+    # wavs 下的文件按位置命名，keys.json 记录每个位置对应的缓存键，译文修改后据此判断文件是否过期
+    output_paths = [os.path.join(output_folder, f'{str(i).zfill(4)}.wav') for i in range(len(transcript))]
+    speaker_wavs = [os.path.join(folder, 'SPEAKER', f'{line["speaker"]}.wav') for line in transcript]
+    keys_path = os.path.join(output_folder, 'keys.json')
+    old_keys = {}
+    if os.path.exists(keys_path):
+        with open(keys_path, 'r', encoding='utf-8') as f:
+            old_keys = json.load(f)
+    keys = [None] * len(transcript)
+    hits = set()
+    if method in ['xtts', 'EdgeTTS']:
+        for i in range(len(transcript)):
+            keys[i] = clip_key(method, texts[i], target_language, voice, speaker_wavs[i], speeds[i])
+            if fetch_cached_clip(keys[i], old_keys.get(str(i)), output_paths[i]):
+                hits.add(i)
         
-    full_wav = np.zeros((0, ))
+    if method == 'xtts' and torch.cuda.is_available():
+        # 同一说话人的句子共享条件向量，先按说话人分组批量合成，下面合成时会跳过已生成的文件
+        groups = {}
+        for i, line in enumerate(transcript):
+            groups.setdefault(line['speaker'], []).append(i)
+        for speaker, indices in groups.items():
+            xtts_tts_batch(
+                [texts[i] for i in indices],
+                [output_paths[i] for i in indices],
+                os.path.join(folder, 'SPEAKER', f'{speaker}.wav'),
+                target_language=target_language,
+                speeds=[speeds[i] for i in indices])
+    clips = [None] * len(transcript)
+    if method == 'EdgeTTS':
+        # 整个视频的句子并发请求 EdgeTTS，直接解码保存为 wav
+        clips = edge_tts_batch(
+            texts, output_paths,
+            target_language=target_language, voice=voice, speeds=speeds)
+
+    # 第一阶段：所有句子交给合成池，得到每句的波形，与时间轴无关
+    sample_rate = 24000
+    t_start = time.time()
+    executor, workers, owned = get_executor(method, speaker_wavs[0] if speaker_wavs else None, target_language)
+    try:
+        for wave_start in range(0, len(transcript), workers * 2):
+            wave = [i for i in range(wave_start, min(wave_start + workers * 2, len(transcript))) if clips[i] is None]
+            futures = {}
+            for i in wave:
+                if speeds[i] is None:
+                    speeds[i] = estimate_speed(texts[i], transcript[i]['end'] - transcript[i]['start'], chars_per_second)
+                if keys[i] is None:
+                    keys[i] = clip_key(method, texts[i], target_language, voice, speaker_wavs[i], speeds[i])
+                    if fetch_cached_clip(keys[i], old_keys.get(str(i)), output_paths[i]):
+                        hits.add(i)
+                futures[i] = executor.submit(
+                    synthesize_line, method, texts[i], output_paths[i], speaker_wavs[i],
+                    target_language, voice, speeds[i], sample_rate)
+            for i in wave:
+                clips[i] = futures[i].result()
+                if texts[i] and len(clips[i]):
+                    # 按实际时长更新语速估计，换算回正常语速
+                    chars_per_second = 0.8 * chars_per_second + 0.2 * len(texts[i]) / (len(clips[i]) / sample_rate * speeds[i])
+    except BrokenProcessPool:
+        # 常驻的 XTTS 进程池损坏后不能再用，丢弃它，重试时重新创建；已合成的句子保留在 wavs 下
+        if method == 'xtts' and not owned:
+            xtts_reset_cpu_executor()
+        raise
+    finally:
+        if owned:
+            executor.shutdown()
+    logger.info(f'{method} 合成 {len(transcript)} 句，{workers} 个 worker，用时 {time.time() - t_start:.2f}s')
+    for i in range(len(transcript)):
+        if i not in hits:
+            tts_cache.store(keys[i], output_paths[i])
+    with open(keys_path, 'w', encoding='utf-8') as f:
+        json.dump({str(i): key for i, key in enumerate(keys)}, f, indent=2)
+    logger.info(f'TTS 片段缓存命中 {len(hits)}/{len(transcript)} 句')
+
+    # 第二阶段：按顺序放到时间轴上，只做时长计算、伸缩和混音
+    # 按译文结束时间预分配整条音轨，逐句按采样点下标写入，不够时再扩容
+    full_wav = np.zeros((int(transcript[-1]['end'] * sample_rate) + sample_rate, ) if transcript else (0, ), dtype=np.float32)
+    cursor = 0
+    stretch_time, stretched_length, skipped_length, num_skipped = 0, 0, 0, 0
     for i, line in enumerate(transcript):
-        speaker = line['speaker']
-        text = preprocess_text(line['translation'])
-        output_path = os.path.join(output_folder, f'{str(i).zfill(4)}.wav')
-        speaker_wav = os.path.join(folder, 'SPEAKER', f'{speaker}.wav')
-        # if num_speakers == 1:
-            # bytedance_tts(text, output_path, speaker_wav, voice_type='BV701_streaming')
-        
-        if method == 'bytedance':
-            bytedance_tts(text, output_path, speaker_wav, target_language = target_language)
-        elif method == 'xtts':
-            xtts_tts(text, output_path, speaker_wav, target_language = target_language)
-        elif method == 'cosyvoice':
-            cosyvoice_tts(text, output_path, speaker_wav, target_language = target_language)
-        elif method == 'EdgeTTS':
-            edge_tts(text, output_path, target_language = target_language, voice = voice)
         start = line['start']
         end = line['end']
         length = end-start
-        last_end = len(full_wav)/24000
-        if start > last_end:
-            full_wav = np.concatenate((full_wav, np.zeros((int((start - last_end) * 24000), ))))
-        start = len(full_wav)/24000
+        start = max(start, cursor/sample_rate)
         line['start'] = start
         if i < len(transcript) - 1:
             next_line = transcript[i+1]
             next_end = next_line['end']
             end = min(start + length, next_end)
-        wav, length = adjust_audio_length(output_path, end-start)
+        wav = clips[i]
+        t_start = time.time()
+        wav_length = len(wav)
+        wav, length = adjust_audio_length(wav, end-start, sample_rate=sample_rate)
+        if len(wav) == wav_length:
+            num_skipped += 1
+            skipped_length += wav_length / sample_rate
+        else:
+            stretch_time += time.time() - t_start
+            stretched_length += wav_length / sample_rate
 
-        full_wav = np.concatenate((full_wav, wav))
+        offset = max(int(round(start * sample_rate)), cursor)
+        if offset + len(wav) > len(full_wav):
+            full_wav = np.pad(full_wav, (0, max(offset + len(wav) - len(full_wav), len(full_wav)//2)))
+        full_wav[offset:offset + len(wav)] = wav
+        cursor = offset + len(wav)
         line['end'] = start + length
+    full_wav = full_wav[:cursor]
+    avoided = f'，约节省 {stretch_time / stretched_length * skipped_length:.2f}s' if stretched_length else ''
+    logger.info(f'按目标时长合成：{num_skipped}/{len(transcript)} 句无需时间伸缩（{skipped_length:.1f}s 音频）{avoided}，伸缩耗时 {stretch_time:.2f}s')
         
     vocal_wav, sr = librosa.load(os.path.join(folder, 'audio_vocals.wav'), sr=24000)
     full_wav = full_wav / np.max(np.abs(full_wav)) * np.max(np.abs(vocal_wav))
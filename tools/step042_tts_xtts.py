@@ -1,17 +1,45 @@
 import os
+import json
+import time
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from TTS.api import TTS
 from loguru import logger
 import numpy as np
 import torch
-import time
 from .utils import save_wav
+from .tts_cache import file_hash
 model = None
+# 传给 inference 的生成参数，取自模型配置；片段缓存键也包含这些参数
+generation_params = ['temperature', 'length_penalty', 'repetition_penalty', 'top_k', 'top_p']
+# 各模型路径对应的缓存键参数，模型未加载时从 config.json 读取
+model_settings = {}
+# 同一说话人一次批量生成的句子数
+batch_size = int(os.getenv('XTTS_BATCH_SIZE', 4))
+# 每个说话人参考音频对应的 (修改时间, (gpt_cond_latent, speaker_embedding))
+speaker_latents = {}
+# 是否为每个说话人预先计算条件前缀的 GPT KV cache，每句生成直接从该 cache 开始
+use_prefix_kv_cache = os.getenv('XTTS_PREFIX_KV_CACHE', '1') == '1'
+# 每个说话人参考音频对应的 (修改时间, prefix_kv_cache)
+speaker_prefix_kv = {}
+# CPU 多进程合成：进程数和每个进程的线程数，XTTS_CPU_WORKERS=calibrate 时先做一次标定
+cpu_workers = os.getenv('XTTS_CPU_WORKERS', '')
+cpu_threads = int(os.getenv('XTTS_CPU_THREADS', 0))
+calibration_path = 'models/TTS/xtts_cpu_calibration.json'
+# 每个进程加载一份模型所需的内存（字节），用于限制进程数
+worker_memory = 3 * 1024 ** 3
+cpu_executor = None
+cpu_executor_shape = None
+cpu_executor_workers = 0
 
 '''
 Supported languages: Arabic: ar, Brazilian Portuguese: pt , Mandarin Chinese: zh-cn, Czech: cs, Dutch: nl, English: en, French: fr, German: de, Italian: it, Polish: pl, Russian: ru, Spanish: es, Turkish: tr, Japanese: ja, Korean: ko, Hungarian: hu, Hindi: hi
 '''
 def init_TTS():
-    load_model()
+    # CPU 上由常驻进程池中的各进程各自加载模型（见 get_cpu_executor），主进程不再多占一份内存
+    if torch.cuda.is_available():
+        load_model()
     
 def load_model(model_path="models/TTS/XTTS-v2", device='auto'):
     global model
@@ -55,7 +83,75 @@ language_map = {
     'Hindi': 'hi',
     'Korean': 'ko',
 }
-def tts(text, output_path, speaker_wav, model_name="models/TTS/XTTS-v2", device='auto', target_language='中文'):
+def get_speaker_latents(speaker_wav):
+    """
+    计算说话人参考音频的条件向量，每个说话人只算一次。
+    结果同时保存在参考音频旁边（SPEAKER/<id>.xtts_latents.pt），重跑时直接读取。
+    """
+    key = os.path.abspath(speaker_wav)
+    mtime = os.path.getmtime(speaker_wav)
+    cached = speaker_latents.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    xtts = model.synthesizer.tts_model
+    latents_path = os.path.splitext(speaker_wav)[0] + '.xtts_latents.pt'
+    if os.path.exists(latents_path) and os.path.getmtime(latents_path) >= mtime:
+        data = torch.load(latents_path, map_location='cpu')
+        latents = (data['gpt_cond_latent'], data['speaker_embedding'])
+    else:
+        config = xtts.config
+        gpt_cond_latent, speaker_embedding = xtts.get_conditioning_latents(
+            audio_path=speaker_wav,
+            gpt_cond_len=config.gpt_cond_len,
+            gpt_cond_chunk_len=config.gpt_cond_chunk_len,
+            max_ref_length=config.max_ref_len,
+            sound_norm_refs=config.sound_norm_refs,
+        )
+        latents = (gpt_cond_latent.cpu(), speaker_embedding.cpu())
+        # 多个 CPU 进程可能同时计算同一说话人，先写临时文件再原子替换，避免读到写了一半的文件
+        tmp_path = f'{latents_path}.{os.getpid()}.tmp'
+        torch.save({'gpt_cond_latent': latents[0], 'speaker_embedding': latents[1]}, tmp_path)
+        os.replace(tmp_path, latents_path)
+        logger.info(f'Saved XTTS speaker latents to {latents_path}')
+    speaker_latents[key] = (mtime, latents)
+    return latents
+
+def get_prefix_kv_cache(speaker_wav):
+    """条件前缀的 KV cache 只保存在内存中（与设备相关），关闭该选项时返回 None"""
+    if not use_prefix_kv_cache:
+        return None
+    key = os.path.abspath(speaker_wav)
+    mtime = os.path.getmtime(speaker_wav)
+    cached = speaker_prefix_kv.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    gpt_cond_latent, _ = get_speaker_latents(speaker_wav)
+    prefix_kv_cache = model.synthesizer.tts_model.get_prefix_kv_cache(gpt_cond_latent)
+    speaker_prefix_kv[key] = (mtime, prefix_kv_cache)
+    return prefix_kv_cache
+
+def cache_settings(model_name="models/TTS/XTTS-v2"):
+    """片段缓存键中的模型标识（路径和 config.json 的哈希）和生成参数"""
+    if model_name not in model_settings:
+        config_path = os.path.join(model_name, 'config.json')
+        if model is not None:
+            config = model.synthesizer.tts_model.config
+            params = {name: getattr(config, name) for name in generation_params}
+        elif os.path.exists(config_path):
+            with open(config_path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+            params = {name: config.get(name) for name in generation_params}
+        else:
+            params = {}
+        model_settings[model_name] = {
+            'model': model_name,
+            'version': file_hash(config_path) if os.path.exists(config_path) else None,
+            **params,
+        }
+    return model_settings[model_name]
+
+def tts(text, output_path, speaker_wav, model_name="models/TTS/XTTS-v2", device='auto', target_language='中文', speed=1.0):
     global model
     language = language_map[target_language]
     assert language in ['ar', 'pt', 'zh-cn', 'cs', 'nl', 'en', 'fr', 'de', 'it', 'pl', 'ru', 'es', 'tr', 'ja', 'ko', 'hu', 'hi']
@@ -66,10 +162,20 @@ def tts(text, output_path, speaker_wav, model_name="models/TTS/XTTS-v2", device=
     if model is None:
         load_model(model_name, device)
     
+    xtts = model.synthesizer.tts_model
+    config = xtts.config
+    gpt_cond_latent, speaker_embedding = get_speaker_latents(speaker_wav)
+    prefix_kv_cache = get_prefix_kv_cache(speaker_wav)
     for retry in range(3):
         try:
-            wav = model.tts(text, speaker_wav=speaker_wav, language=language)
-            wav = np.array(wav)
+            out = xtts.inference(
+                text, language, gpt_cond_latent, speaker_embedding,
+                **{name: getattr(config, name) for name in generation_params},
+                speed=speed,
+                prefix_kv_cache=prefix_kv_cache,
+                enable_text_splitting=True,
+            )
+            wav = np.array(out['wav'])
             save_wav(wav, output_path)
             logger.info(f'TTS {text}')
             break
@@ -78,6 +184,155 @@ def tts(text, output_path, speaker_wav, model_name="models/TTS/XTTS-v2", device=
             logger.warning(e)
 
 
+def tts_batch(texts, output_paths, speaker_wav, model_name="models/TTS/XTTS-v2", device='auto', target_language='中文', speeds=None):
+    """
+    同一说话人的多句文本批量合成：共享条件向量，GPT 一次生成一批句子。
+    已存在的文件跳过；超过单句长度上限或批量失败的句子逐句合成。speeds 为每句的语速倍率。
+    """
+    global model
+    language = language_map[target_language]
+    if model is None:
+        load_model(model_name, device)
+    xtts = model.synthesizer.tts_model
+    config = xtts.config
+    gpt_cond_latent, speaker_embedding = get_speaker_latents(speaker_wav)
+    prefix_kv_cache = get_prefix_kv_cache(speaker_wav)
+
+    if speeds is None:
+        speeds = [1.0] * len(texts)
+    char_limit = xtts.tokenizer.char_limits.get(language.split('-')[0], 250)
+    pending = [(text, path, speed) for text, path, speed in zip(texts, output_paths, speeds)
+               if not os.path.exists(path) and len(text) <= char_limit]
+    # 按长度排序，减少同一批内的填充
+    pending.sort(key=lambda item: len(item[0]))
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        try:
+            outputs = xtts.inference_batch(
+                [text for text, _, _ in batch], language, gpt_cond_latent, speaker_embedding,
+                **{name: getattr(config, name) for name in generation_params},
+                speed=[speed for _, _, speed in batch],
+                prefix_kv_cache=prefix_kv_cache,
+            )
+        except Exception as e:
+            logger.warning(f'XTTS 批量合成失败，改为逐句合成')
+            logger.warning(e)
+            continue
+        for (text, path, _), out in zip(batch, outputs):
+            save_wav(np.array(out['wav']), path)
+            logger.info(f'TTS {text}')
+
+    for text, path, speed in zip(texts, output_paths, speeds):
+        tts(text, path, speaker_wav, model_name, device, target_language, speed=speed)
+
+
+def init_cpu_worker(core_queue, model_name):
+    """CPU worker 初始化：绑定到分配的一组核心（只有 Linux 支持），线程数与核心数一致，并预先加载模型"""
+    cores = core_queue.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    torch.set_num_interop_threads(1)
+    load_model(model_name, 'cpu')
+
+def available_cores():
+    # Windows 和 macOS 没有 sched_getaffinity，按全部核心计算，不绑定
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def max_cpu_workers():
+    try:
+        memory = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return len(available_cores())
+    # 主进程已经加载了模型时扣除这一份
+    if model is not None:
+        memory -= worker_memory
+    return max(1, memory // worker_memory)
+
+def start_cpu_executor(num_workers, num_threads, model_name="models/TTS/XTTS-v2"):
+    """启动 num_workers 个进程，每个进程绑定 num_threads 个互不重叠的核心"""
+    cores = available_cores()
+    num_workers = max(1, min(num_workers, len(cores) // num_threads, max_cpu_workers()))
+    ctx = multiprocessing.get_context('spawn')
+    core_queue = ctx.Queue()
+    for i in range(num_workers):
+        core_queue.put(cores[i * num_threads:(i + 1) * num_threads])
+    executor = ProcessPoolExecutor(num_workers, mp_context=ctx, initializer=init_cpu_worker, initargs=(core_queue, model_name))
+    logger.info(f'XTTS CPU: {num_workers} 个进程 x {num_threads} 线程')
+    return executor, num_workers
+
+def calibrate_cpu_workers(speaker_wav, target_language='中文', model_name="models/TTS/XTTS-v2", candidates=(1, 2, 4, 8, 16)):
+    """
+    用同一句话在几组 (进程数, 线程数) 下各合成一轮，选出每秒合成句数最高的组合并保存。
+    模型加载时间不计入。
+    """
+    text = {'中文': '今天天气不错，我们一起去公园散步吧。'}.get(target_language, 'The weather is nice today, let us take a walk in the park.')
+    cores = available_cores()
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for num_threads in candidates:
+            num_workers = min(len(cores) // num_threads, max_cpu_workers())
+            if num_workers < 1:
+                continue
+            executor, num_workers = start_cpu_executor(num_workers, num_threads, model_name)
+            with executor:
+                # 每个进程先合成一句预热，确保模型和说话人条件都已加载
+                warmup = [executor.submit(tts, text, os.path.join(folder, f'warmup_{num_threads}_{i}.wav'), speaker_wav, model_name, 'cpu', target_language)
+                          for i in range(num_workers)]
+                for future in warmup:
+                    future.result()
+                t_start = time.time()
+                futures = [executor.submit(tts, text, os.path.join(folder, f'{num_threads}_{i}.wav'), speaker_wav, model_name, 'cpu', target_language)
+                           for i in range(num_workers * 2)]
+                for future in futures:
+                    future.result()
+                throughput = len(futures) / (time.time() - t_start)
+            logger.info(f'XTTS CPU 标定: {num_workers} 进程 x {num_threads} 线程, {throughput:.2f} 句/秒')
+            results.append((throughput, num_workers, num_threads))
+    throughput, num_workers, num_threads = max(results)
+    os.makedirs(os.path.dirname(calibration_path), exist_ok=True)
+    with open(calibration_path, 'w', encoding='utf-8') as f:
+        json.dump({'cores': len(cores), 'workers': num_workers, 'threads': num_threads, 'throughput': throughput}, f, indent=2)
+    return num_workers, num_threads
+
+def get_cpu_executor(speaker_wav=None, target_language='中文', model_name="models/TTS/XTTS-v2"):
+    """
+    返回常驻的 CPU 进程池及其进程数，进程数和线程数依次取自环境变量（XTTS_CPU_WORKERS 为 0 时视为自动）、
+    标定结果，否则按每进程 4 个线程划分全部核心。
+    """
+    global cpu_executor, cpu_executor_shape, cpu_executor_workers
+    cores = available_cores()
+    if cpu_workers == 'calibrate' and not os.path.exists(calibration_path) and speaker_wav is not None:
+        shape = calibrate_cpu_workers(speaker_wav, target_language, model_name)
+    elif cpu_workers.isdigit() and int(cpu_workers) >= 1:
+        num_threads = cpu_threads or max(1, len(cores) // int(cpu_workers))
+        shape = (int(cpu_workers), num_threads)
+    elif os.path.exists(calibration_path):
+        with open(calibration_path, 'r', encoding='utf-8') as f:
+            calibration = json.load(f)
+        shape = (calibration['workers'], calibration['threads'])
+        if calibration['cores'] != len(cores):
+            num_threads = calibration['threads']
+            shape = (len(cores) // num_threads, num_threads)
+    else:
+        num_threads = cpu_threads or min(4, len(cores))
+        shape = (len(cores) // num_threads, num_threads)
+    if cpu_executor is None or cpu_executor_shape != shape:
+        if cpu_executor is not None:
+            cpu_executor.shutdown()
+        cpu_executor, cpu_executor_workers = start_cpu_executor(*shape, model_name=model_name)
+        cpu_executor_shape = shape
+    return cpu_executor, cpu_executor_workers
+
+def reset_cpu_executor():
+    """进程池损坏（如某个进程内存不足被杀）后调用，下次 get_cpu_executor 时重新创建"""
+    global cpu_executor, cpu_executor_shape, cpu_executor_workers
+    if cpu_executor is not None:
+        cpu_executor.shutdown(wait=False, cancel_futures=True)
+    cpu_executor, cpu_executor_shape, cpu_executor_workers = None, None, 0
+
 if __name__ == '__main__':
     speaker_wav = r'videos/村长台钓加拿大/20240805 英文无字幕 阿里这小子在水城威尼斯发来问候/audio_vocals.wav'
     os.makedirs('playground', exist_ok=True)
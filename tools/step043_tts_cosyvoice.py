@@ -1,9 +1,12 @@
 import os
+import inspect
+from collections import OrderedDict
 from loguru import logger
 import numpy as np
 import torch
 import time
 from .utils import save_wav
+from .tts_cache import file_hash
 import sys
 sys.path.append('CosyVoice/third_party/Matcha-TTS')
 sys.path.append('CosyVoice/')
@@ -13,6 +16,12 @@ import torchaudio
 from modelscope import snapshot_download
 model = None
 
+# 每个说话人的提示特征（语音 token、声学特征和说话人向量）只提取一次，最多保留最近使用的若干个说话人
+max_cached_prompts = int(os.getenv('COSYVOICE_PROMPT_CACHE_SIZE', 8))
+# 参考音频只取开头一段，提取成本不随说话人讲话总时长增长
+max_prompt_seconds = float(os.getenv('COSYVOICE_PROMPT_SECONDS', 10))
+prompt_cache = OrderedDict()
+
 def download_cosyvoice():
     snapshot_download('iic/CosyVoice-300M', local_dir='models/TTS/CosyVoice-300M')
 
@@ -43,7 +52,47 @@ language_map = {
     'Korean': 'ko'
 }
 
-def tts(text, output_path, speaker_wav, model_name="models/TTS/CosyVoice-300M", device='auto', target_language='中文'):
+def get_prompt(speaker_wav):
+    key = (speaker_wav, os.path.getmtime(speaker_wav))
+    if key in prompt_cache:
+        prompt_cache.move_to_end(key)
+        return prompt_cache[key]
+    prompt_speech_16k = load_wav(speaker_wav, 16000)[:, :int(max_prompt_seconds * 16000)]
+    # 用空文本调用一次前端，得到与文本无关的提示特征，逐句合成时只替换文本 token
+    if 'resample_rate' in inspect.signature(model.frontend.frontend_cross_lingual).parameters:
+        prompt = model.frontend.frontend_cross_lingual('', prompt_speech_16k, model.sample_rate)
+    else:
+        prompt = model.frontend.frontend_cross_lingual('', prompt_speech_16k)
+    prompt.pop('text', None)
+    prompt.pop('text_len', None)
+    prompt_cache[key] = prompt
+    while len(prompt_cache) > max_cached_prompts:
+        prompt_cache.popitem(last=False)
+    return prompt
+
+def synthesize(text, prompt, speed=1.0):
+    tts_speeches = []
+    for segment in model.frontend.text_normalize(text, split=True):
+        text_token, text_token_len = model.frontend._extract_text_token(segment)
+        model_input = dict(prompt, text=text_token, text_len=text_token_len)
+        if hasattr(model.model, 'tts'):
+            for output in model.model.tts(**model_input, stream=False, speed=speed):
+                tts_speeches.append(output['tts_speech'])
+        else:
+            # 旧版 CosyVoice 不支持 speed 参数，此时由后续的时间伸缩对齐时长
+            tts_speeches.append(model.model.inference(**model_input)['tts_speech'])
+    return torch.concat(tts_speeches, dim=1)
+
+def cache_settings(model_name="models/TTS/CosyVoice-300M"):
+    """片段缓存键中的模型标识（路径和 cosyvoice.yaml 的哈希）和参考音频截取长度"""
+    config_path = os.path.join(model_name, 'cosyvoice.yaml')
+    return {
+        'model': model_name,
+        'version': file_hash(config_path) if os.path.exists(config_path) else None,
+        'prompt_seconds': max_prompt_seconds,
+    }
+
+def tts(text, output_path, speaker_wav, model_name="models/TTS/CosyVoice-300M", device='auto', target_language='中文', speed=1.0):
     global model
     
     if os.path.exists(output_path):
@@ -55,9 +104,9 @@ def tts(text, output_path, speaker_wav, model_name="models/TTS/CosyVoice-300M",
     
     for retry in range(3):
         try:
-            prompt_speech_16k = load_wav(speaker_wav, 16000)
-            output = model.inference_cross_lingual(f'<|{language_map[target_language]}|>{text}', prompt_speech_16k)
-            torchaudio.save(output_path, output['tts_speech'], 22050)
+            prompt = get_prompt(speaker_wav)
+            tts_speech = synthesize(f'<|{language_map[target_language]}|>{text}', prompt, speed)
+            torchaudio.save(output_path, tts_speech, getattr(model, 'sample_rate', 22050))
 
             logger.info(f'TTS {text}')
             break
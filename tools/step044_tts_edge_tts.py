@@ -1,15 +1,16 @@
 import os
+import asyncio
+import subprocess
 from loguru import logger
 import numpy as np
-import torch
-import time
+import edge_tts
 from .utils import save_wav
-import sys
-
-import torchaudio
-model = None
-
 
+# 同时与 EdgeTTS 服务保持的最大连接数
+max_concurrency = int(os.getenv('EDGE_TTS_CONCURRENCY', 8))
+# 音调和音量，与语速一样是 EdgeTTS 的合成参数
+pitch = os.getenv('EDGE_TTS_PITCH', '+0Hz')
+volume = os.getenv('EDGE_TTS_VOLUME', '+0%')
 
 #  <|zh|><|en|><|jp|><|yue|><|ko|> for Chinese/English/Japanese/Cantonese/Korean
 language_map = {
@@ -20,18 +21,74 @@ language_map = {
     'Korean': 'ko-KR-SunHiNeural'
 }
 
-def tts(text, output_path, target_language='中文', voice = 'zh-CN-XiaoxiaoNeural'):
+def decode_mp3(data, sample_rate=24000):
+    """用 ffmpeg 把 EdgeTTS 返回的 mp3 字节解码为单声道 float32 PCM"""
+    result = subprocess.run(
+        ['ffmpeg', '-loglevel', 'error', '-i', 'pipe:0', '-f', 'f32le', '-ac', '1', '-ar', str(sample_rate), 'pipe:1'],
+        input=data, capture_output=True, check=True)
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+async def synthesize(text, voice, semaphore, rate='+0%', retries=3):
+    async with semaphore:
+        for retry in range(retries):
+            try:
+                communicate = edge_tts.Communicate(text, voice, rate=rate, pitch=pitch, volume=volume)
+                audio = bytearray()
+                async for chunk in communicate.stream():
+                    if chunk['type'] == 'audio':
+                        audio.extend(chunk['data'])
+                if not audio:
+                    raise Exception('EdgeTTS 没有返回音频')
+                return bytes(audio)
+            except Exception as e:
+                logger.warning(f'TTS {text} 失败')
+                logger.warning(e)
+                error = e
+        raise error
+
+def cache_settings():
+    """片段缓存键中的合成参数，语速单独记录"""
+    return {'pitch': pitch, 'volume': volume}
+
+def speed_to_rate(speed):
+    """把语速倍率转换为 EdgeTTS 的 rate 参数，如 1.2 -> '+20%'"""
+    return f'{round((speed - 1) * 100):+d}%'
+
+async def synthesize_all(texts, voice, concurrency, rates):
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*(synthesize(text, voice, semaphore, rate=rate) for text, rate in zip(texts, rates)), return_exceptions=True)
+
+def tts_batch(texts, output_paths, target_language='中文', voice='zh-CN-XiaoxiaoNeural', concurrency=max_concurrency, speeds=None):
+    """
+    并发合成一个视频的所有句子，并发连接数不超过 concurrency，speeds 为每句的语速倍率。
+    返回每句解码后的 24kHz PCM（已存在的文件返回 None），同时保存为 output_paths 对应的 wav。
+    """
+    wavs = [None] * len(texts)
+    if speeds is None:
+        speeds = [1.0] * len(texts)
+    pending = [i for i, path in enumerate(output_paths) if not os.path.exists(path)]
+    if not pending:
+        return wavs
+    results = asyncio.run(synthesize_all([texts[i] for i in pending], voice, concurrency,
+                                         [speed_to_rate(speeds[i]) for i in pending]))
+    failed = []
+    for i, result in zip(pending, results):
+        if isinstance(result, Exception):
+            failed.append(i)
+            continue
+        wav = decode_mp3(result)
+        save_wav(wav, output_paths[i])
+        wavs[i] = wav
+        logger.info(f'TTS {texts[i]}')
+    if failed:
+        raise Exception(f'EdgeTTS 合成失败的句子: {failed}')
+    return wavs
+
+def tts(text, output_path, target_language='中文', voice = 'zh-CN-XiaoxiaoNeural', speed=1.0):
     if os.path.exists(output_path):
         logger.info(f'TTS {text} 已存在')
         return
-    for retry in range(3):
-        try:
-            os.system(f'edge-tts --text "{text}" --write-media "{output_path.replace(".wav", ".mp3")}" --voice {voice}')
-            logger.info(f'TTS {text}')
-            break
-        except Exception as e:
-            logger.warning(f'TTS {text} 失败')
-            logger.warning(e)
+    tts_batch([text], [output_path], target_language=target_language, voice=voice, speeds=[speed])
 
 
 if __name__ == '__main__':
@@ -39,4 +96,4 @@ if __name__ == '__main__':
     while True:
         text = input('请输入：')
         tts(text, f'playground/{text}.wav', target_language='中文')
-        
+
@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 import json
 import os
+import re
+import hashlib
 import shutil
-import string
 import subprocess
-import time
-import random
-import traceback
+import bisect
+from concurrent.futures import ThreadPoolExecutor
 
 from loguru import logger
+from .utils import core_budget, get_duration, run_ffmpeg_progress
+
+# 分段并行编码：每段至少多长（秒），以及每个 ffmpeg 进程使用的线程数
+min_chunk_seconds = float(os.getenv('FFMPEG_MIN_CHUNK_SECONDS', 60))
+chunk_threads = int(os.getenv('FFMPEG_CHUNK_THREADS', 4))
 
 
 def split_text(input_data,
@@ -63,12 +68,15 @@ def format_timestamp(seconds):
     minutes, seconds = divmod(seconds, 60)
     return f"{hours:02}:{minutes:02}:{seconds:02},{millisec:03}"
 
-def generate_srt(translation, srt_path, speed_up=1, max_line_char=30):
+def generate_srt(translation, srt_path, speed_up=1, max_line_char=30, offset=0, duration=None):
+    """offset 和 duration 为输出时间轴上的一段（秒），用于分段编码时每段各自的字幕"""
     translation = split_text(translation)
+    translation = [line for line in translation
+                   if line['end']/speed_up > offset and (duration is None or line['start']/speed_up < offset + duration)]
     with open(srt_path, 'w', encoding='utf-8') as f:
         for i, line in enumerate(translation):
-            start = format_timestamp(line['start']/speed_up)
-            end = format_timestamp(line['end']/speed_up)
+            start = format_timestamp(max(line['start']/speed_up - offset, 0))
+            end = format_timestamp(line['end']/speed_up - offset)
             text = line['translation']
             line = len(text)//(max_line_char+1) + 1
             avg = min(round(len(text)/line), max_line_char)
@@ -79,12 +87,43 @@ def generate_srt(translation, srt_path, speed_up=1, max_line_char=30):
             f.write(f'{text}\n\n')
 
 
-def get_aspect_ratio(video_path):
+def get_video_size(video_path):
     command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
                '-show_entries', 'stream=width,height', '-of', 'json', video_path]
     result = subprocess.run(command, capture_output=True, text=True)
     dimensions = json.loads(result.stdout)['streams'][0]
-    return dimensions['width'] / dimensions['height']
+    return dimensions['width'], dimensions['height']
+
+def get_keyframes(video_path):
+    """读取视频流所有关键帧的时间（只读包信息，不解码）"""
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+               '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', video_path]
+    result = subprocess.run(command, capture_output=True, text=True)
+    keyframes = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            keyframes.append(float(pts_time))
+    return sorted(keyframes)
+
+def split_at_keyframes(keyframes, duration, num_chunks):
+    """在最接近等分点的关键帧处切分，返回各段的 (开始, 结束)"""
+    points = [0.0]
+    for i in range(1, num_chunks):
+        target = duration * i / num_chunks
+        j = bisect.bisect_left(keyframes, target)
+        candidates = keyframes[max(j - 1, 0):j + 1]
+        if not candidates:
+            continue
+        point = min(candidates, key=lambda t: abs(t - target))
+        if point - points[-1] >= min_chunk_seconds / 2 and duration - point >= min_chunk_seconds / 2:
+            points.append(point)
+    points.append(duration)
+    return list(zip(points[:-1], points[1:]))
+
+def get_aspect_ratio(video_path):
+    width, height = get_video_size(video_path)
+    return width / height
 
 
 def convert_resolution(aspect_ratio, resolution='1080p'):
@@ -101,7 +140,158 @@ def convert_resolution(aspect_ratio, resolution='1080p'):
     # return f'{width}x{height}'
     return width, height
     
-def synthesize_video(folder, subtitles=True, speed_up=1.00, fps=30, resolution='1080p', background_music=None, watermark_path=None, bgm_volume=0.5, video_volume=1.0):
+def escape_filter_path(path):
+    """
+    把路径写成滤镜选项值：统一为 / 分隔后用单引号括起（选项层），再转义滤镜图层的 \\ ' [ ] , ;，
+    路径里的冒号、逗号、方括号和引号都不会破坏滤镜图。
+    """
+    path = path.replace('\\', '/')
+    quoted = "'" + path.replace("'", "'\\''") + "'"
+    return re.sub(r"([\\'\[\],;])", r'\\\1', quoted)
+
+def make_subtitle_filter(srt_name, font_size, outline, font_path="./font/SimHei.ttf"):
+    return f"subtitles={escape_filter_path(srt_name)}:fontsdir={escape_filter_path(os.path.abspath(os.path.dirname(font_path)))}:force_style='FontName=SimHei,FontSize={font_size},PrimaryColour=&HFFFFFF,OutlineColour=&H000000,Outline={outline},WrapStyle=2'"
+
+def build_video_filter(speed_up, width, height, subtitle_filter=None, watermark_input=None):
+    """变速后叠加水印，再缩放到目标分辨率，最后烧录字幕，输出 [v]"""
+    filters = [f"[0:v]setpts=PTS/{speed_up}[sped]"]
+    video = 'sped'
+    if watermark_input is not None:
+        filters.append(f"[{watermark_input}:v]scale=iw*0.15:ih*0.15[wm];[{video}][wm]overlay=W-w-10:H-h-10[marked]")
+        video = 'marked'
+    if subtitle_filter:
+        filters.append(f"[{video}]scale={width}:{height}[scaled];[scaled]{subtitle_filter}[v]")
+    else:
+        filters.append(f"[{video}]scale={width}:{height}[v]")
+    return ';'.join(filters)
+
+def build_audio_filter(speed_up, audio_input=1, bgm_input=None, bgm_volume=0.5, video_volume=1.0):
+    """配音变速并与背景音乐混音，输出 [a]"""
+    if bgm_input is not None:
+        return f"[{audio_input}:a]atempo={speed_up},volume={video_volume}[a0];[{bgm_input}:a]volume={bgm_volume}[a1];[a0][a1]amix=inputs=2:duration=first[a]"
+    return f"[{audio_input}:a]atempo={speed_up}[a]"
+
+def build_filter_graph(speed_up, width, height, subtitle_filter=None, watermark_input=None, bgm_input=None, bgm_volume=0.5, video_volume=1.0):
+    """
+    一次解码/编码完成变速、水印、缩放、字幕和背景音乐混音，输出 [v] 和 [a]。
+    顺序与原先的多遍处理一致：变速后叠加水印，再缩放到目标分辨率，最后烧录字幕。
+    """
+    return build_video_filter(speed_up, width, height, subtitle_filter, watermark_input) + ';' + \
+        build_audio_filter(speed_up, 1, bgm_input, bgm_volume, video_volume)
+
+def report_progress(progress_callback, duration, label='视频合成'):
+    """把 ffmpeg 的 (已输出秒数, fps, speed) 换算为百分比，转给 progress_callback(百分比, 状态)"""
+    if progress_callback is None:
+        return None
+    def callback(out_time, fps, speed):
+        percent = min(out_time / duration * 100, 100) if duration else 0
+        progress_callback(percent, f'{label} {percent:.0f}% ({fps:.0f} fps, {speed:.2f}x)')
+    return callback
+
+def run_ffmpeg(command, output_path, cwd=None, threads=None, progress=None, job='ffmpeg'):
+    """
+    在核心预算内运行 ffmpeg（command 不含输出文件），返回是否成功。
+    output_path 为单个 mp4 路径，或 [(输出参数, 路径), ...]，预留的核心平均分给各个输出。
+    progress 为 run_ffmpeg_progress 的进度回调，job 为吞吐量记录里的任务名。
+    """
+    outputs = [(['-f', 'mp4'], output_path)] if isinstance(output_path, str) else output_path
+    with core_budget.reserve(threads or chunk_threads * len(outputs)) as cores:
+        command = list(command)
+        for options, path in outputs:
+            command += ['-threads', str(max(1, cores // len(outputs))), *options, path]
+        command += ['-y']
+        logger.info(f"执行FFmpeg命令: {' '.join(command)}")
+        success, stderr_output = run_ffmpeg_progress(command, progress, cwd=cwd, job=job)
+    if not success:
+        logger.error(f"FFmpeg错误输出: {stderr_output[-2000:]}")
+    return success
+
+def encode_chunked(folder, input_video, chunks, translation, speed_up, fps, width, height, burn, font_size, outline, watermark_path, mux_inputs, audio_filter, srt_input, output_path, progress=None):
+    """
+    在关键帧处把原视频切成若干段，每段用同样的视频滤镜并行编码（字幕按段偏移），
+    再用 concat 分离器无损拼接，并与配音一起封装。progress 收到的是各段进度之和。
+    """
+    chunk_folder = os.path.join(folder, 'chunks')
+    os.makedirs(chunk_folder, exist_ok=True)
+    chunk_progress = [(0.0, 0.0, 0.0)] * len(chunks)
+
+    def chunk_callback(i):
+        if progress is None:
+            return None
+        def callback(out_time, fps, speed):
+            chunk_progress[i] = (out_time, fps, speed)
+            progress(*(sum(values) for values in zip(*chunk_progress)))
+        return callback
+
+    def encode_chunk(i, start, end):
+        subtitle_filter = None
+        if burn:
+            srt_name = f'subtitles_{i:03d}.srt'
+            generate_srt(translation, os.path.join(folder, srt_name), speed_up, offset=start/speed_up, duration=(end-start)/speed_up)
+            subtitle_filter = make_subtitle_filter(srt_name, font_size, outline)
+        inputs = ['-ss', str(start), '-t', str(end - start), '-i', os.path.abspath(input_video)]
+        if watermark_path:
+            inputs += ['-i', os.path.abspath(watermark_path)]
+        command = [
+            'ffmpeg',
+            *inputs,
+            '-filter_complex', build_video_filter(speed_up, width, height, subtitle_filter, 1 if watermark_path else None),
+            '-map', '[v]',
+            '-an',
+            '-r', str(fps),
+            '-c:v', 'libx264',
+        ]
+        return run_ffmpeg(command, os.path.abspath(os.path.join(chunk_folder, f'{i:03d}.mp4')), cwd=folder,
+                          progress=chunk_callback(i), job='synthesize_video_chunk')
+
+    try:
+        with ThreadPoolExecutor(len(chunks)) as executor:
+            results = list(executor.map(encode_chunk, range(len(chunks)), *zip(*chunks)))
+        if not all(results):
+            return False
+        list_path = os.path.join(chunk_folder, 'list.txt')
+        with open(list_path, 'w', encoding='utf-8') as f:
+            for i in range(len(chunks)):
+                f.write(f"file '{i:03d}.mp4'\n")
+        command = ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', os.path.abspath(list_path), *mux_inputs,
+                   '-filter_complex', audio_filter, '-map', '0:v', '-map', '[a]']
+        if srt_input is not None:
+            command += ['-map', f'{srt_input}:s', '-c:s', 'mov_text']
+        command += ['-c:v', 'copy', '-c:a', 'aac']
+        return run_ffmpeg(command, output_path, cwd=folder, threads=1, job='synthesize_video_mux')
+    finally:
+        shutil.rmtree(chunk_folder, ignore_errors=True)
+        for i in range(len(chunks)):
+            srt_chunk = os.path.join(folder, f'subtitles_{i:03d}.srt')
+            if os.path.exists(srt_chunk):
+                os.remove(srt_chunk)
+
+def can_stream_copy(video_size, speed_up, width, height, watermark_path, burn_subtitles):
+    """不变速、分辨率与原视频一致、没有水印且不烧录字幕时，视频流可以直接复制"""
+    return speed_up == 1 and video_size == (width, height) and not watermark_path and not burn_subtitles
+
+def copy_video_command(inputs, srt_input, bgm_input, bgm_volume, video_volume):
+    """
+    复制原视频流，只编码新的 AAC 音轨，字幕作为 mov_text 软字幕封装（不含输出文件）。
+    帧率保持原视频不变。
+    """
+    command = ['ffmpeg', *inputs, '-map', '0:v']
+    if bgm_input is not None:
+        command += ['-filter_complex', f"[1:a]volume={video_volume}[a0];[{bgm_input}:a]volume={bgm_volume}[a1];[a0][a1]amix=inputs=2:duration=first[a]",
+                    '-map', '[a]']
+    else:
+        command += ['-map', '1:a']
+    if srt_input is not None:
+        command += ['-map', f'{srt_input}:s', '-c:s', 'mov_text']
+    command += ['-c:v', 'copy', '-c:a', 'aac']
+    return command
+
+def synthesize_video(folder, subtitles=True, speed_up=1.00, fps=30, resolution='1080p', background_music=None, watermark_path=None, bgm_volume=0.5, video_volume=1.0, burn_subtitles=True, progress_callback=None):
+    """
+    合成最终视频。subtitles 为 True 时默认把字幕烧录进画面，burn_subtitles 为 False 时改为封装 mov_text 软字幕。
+    条件允许时（见 can_stream_copy）直接复制视频流，不重新编码。
+    progress_callback(百分比, 状态) 实时接收渲染进度、编码帧率和速度。
+    """
     # if os.path.exists(os.path.join(folder, 'video.mp4')):
     #     logger.info(f'Video already synthesized in {folder}')
     #     return
@@ -119,260 +309,294 @@ def synthesize_video(folder, subtitles=True, speed_up=1.00, fps=30, resolution='
     srt_path = os.path.join(folder, 'subtitles.srt')
     final_video = os.path.join(folder, 'video.mp4')
     generate_srt(translation, srt_path, speed_up)
-    srt_path = srt_path.replace('\\', '/')
-    aspect_ratio = get_aspect_ratio(input_video)
-    width, height = convert_resolution(aspect_ratio, resolution)
-    resolution = f'{width}x{height}'
+    video_size = get_video_size(input_video)
+    width, height = convert_resolution(video_size[0] / video_size[1], resolution)
     font_size = int(width/128)
     outline = int(round(font_size/8))
-    video_speed_filter = f"setpts=PTS/{speed_up}"
-    audio_speed_filter = f"atempo={speed_up}"
-    font_path = "./font/SimHei.ttf"
-    subtitle_filter = f"subtitles={srt_path}:fontsdir={os.path.dirname(font_path)}:force_style='FontName=SimHei,FontSize={font_size},PrimaryColour=&HFFFFFF,OutlineColour=&H000000,Outline={outline},WrapStyle=2'"
-    # subtitle_filter = f"subtitles={srt_path}:force_style='FontName=Arial,FontSize={font_size},PrimaryColour=&HFFFFFF,OutlineColour=&H000000,Outline={outline},WrapStyle=2'"
+    # ffmpeg 在视频目录下运行，字幕按文件名引用，不必为了路径转义把视频和字幕复制到 temp/
+    subtitle_filter = make_subtitle_filter(os.path.basename(srt_path), font_size, outline)
 
-    filter_complex = f"[0:v]{video_speed_filter}[v];[1:a]{audio_speed_filter}[a]"
-        
-    # Add watermark if specified
+    inputs = ['-i', os.path.abspath(input_video), '-i', os.path.abspath(input_audio)]
+    watermark_input, bgm_input = None, None
     if watermark_path:
-        watermark_filter = f";[2:v]scale=iw*0.15:ih*0.15[wm];[v][wm]overlay=W-w-10:H-h-10[v]"
-        ffmpeg_command = [
-            'ffmpeg',
-            '-i', input_video,
-            '-i', input_audio,
-            '-i', watermark_path,
-            '-filter_complex', filter_complex + watermark_filter,
-            '-map', '[v]',
-            '-map', '[a]',
-            '-r', str(fps),
-            '-s', resolution,
-            '-c:v', 'libx264',
-            '-c:a', 'aac',
-            final_video,
-            '-y',
-            '-threads', '2',
-        ]
-    else:
-        ffmpeg_command = [
-            'ffmpeg',
-            '-i', input_video,
-            '-i', input_audio,
-            '-filter_complex', filter_complex,
-            '-map', '[v]',
-            '-map', '[a]',
-            '-r', str(fps),
-            '-s', resolution,
-            '-c:v', 'libx264',
-            '-c:a', 'aac',
-            final_video,
-            '-y',
-            '-threads', '2',
-        ]
-    subprocess.run(ffmpeg_command)
-    time.sleep(1)
-
-    # Apply background music if specified
+        watermark_input = len(inputs) // 2
+        inputs += ['-i', os.path.abspath(watermark_path)]
     if background_music:
-        final_video_with_bgm = final_video.replace('.mp4', '_bgm.mp4')
-        ffmpeg_command_bgm = [
-            'ffmpeg',
-            '-i', final_video,                # Original video with audio
-            '-i', background_music,           # Background music
-            '-filter_complex', f'[0:a]volume={video_volume}[v0];[1:a]volume={bgm_volume}[v1];[v0][v1]amix=inputs=2:duration=first[a]',
-            '-map', '0:v',                    # Use video from the original input
-            '-map', '[a]',                    # Use the mixed audio
-            '-c:v', 'copy',                       # Copy the original video codec
-            '-c:a', 'aac',                    # Encode the audio as AAC
-            final_video_with_bgm,
-            '-y',
-            '-threads', '2'
-        ]
-        subprocess.run(ffmpeg_command_bgm)
-        os.remove(final_video)
-        os.rename(final_video_with_bgm, final_video)
-        time.sleep(1)
-    # 字幕无所谓，所以直接try catch就好
-    try:
-        if subtitles:
-            final_video_with_subtitles = final_video.replace('.mp4', '_subtitles.mp4')
-            add_subtitles(final_video, srt_path, final_video_with_subtitles, subtitle_filter, 'ffmpeg')
-            # os.remove(final_video)
-            if os.path.exists(final_video):
-                os.remove(final_video)
-            os.rename(final_video_with_subtitles, final_video)
-            time.sleep(1)
-    except Exception as e:
-        logger.info(f"An error occurred: {e}")
-        traceback.format_exc()
-
+        bgm_input = len(inputs) // 2
+        inputs += ['-i', os.path.abspath(background_music)]
+
+    # 软字幕作为单独的输入，封装为 mov_text 字幕轨
+    srt_input = None
+    if subtitles and not burn_subtitles:
+        srt_input = len(inputs) // 2
+        inputs += ['-i', os.path.basename(srt_path)]
+
+    duration = get_duration(input_video)
+    progress = report_progress(progress_callback, duration / speed_up)
+
+    # 先写到临时文件，成功后再原子地替换 video.mp4
+    temp_video = os.path.abspath(final_video + '.tmp')
+    if can_stream_copy(video_size, speed_up, width, height, watermark_path, subtitles and burn_subtitles):
+        if run_ffmpeg(copy_video_command(inputs, srt_input, bgm_input, bgm_volume, video_volume), temp_video, cwd=folder, threads=1,
+                      progress=progress, job='synthesize_video_copy'):
+            os.replace(temp_video, final_video)
+            return final_video
+        logger.warning('复制视频流失败，改为重新编码')
+        if os.path.exists(temp_video):
+            os.remove(temp_video)
+
+    # 足够长的视频在关键帧处分段，在核心预算内并行编码
+    num_chunks = min(int(duration // min_chunk_seconds), core_budget.total // chunk_threads)
+    chunks = split_at_keyframes(get_keyframes(input_video), duration, num_chunks) if num_chunks >= 2 else []
+    if len(chunks) >= 2:
+        logger.info(f'分 {len(chunks)} 段并行编码: {folder}')
+        # 分段编码后封装时的输入：0 为拼接后的视频，其后为配音、背景音乐和软字幕
+        mux_inputs = ['-i', os.path.abspath(input_audio)]
+        mux_bgm_input, mux_srt_input = None, None
+        if background_music:
+            mux_bgm_input = len(mux_inputs) // 2 + 1
+            mux_inputs += ['-i', os.path.abspath(background_music)]
+        if srt_input is not None:
+            mux_srt_input = len(mux_inputs) // 2 + 1
+            mux_inputs += ['-i', os.path.basename(srt_path)]
+        audio_filter = build_audio_filter(speed_up, 1, mux_bgm_input, bgm_volume, video_volume)
+
+    # 字幕无所谓，烧录字幕失败时去掉字幕再渲染一次
+    for burn in ([True, False] if subtitles and burn_subtitles else [False]):
+        if len(chunks) >= 2:
+            success = encode_chunked(folder, input_video, chunks, translation, speed_up, fps, width, height, burn, font_size, outline,
+                                     watermark_path, mux_inputs, audio_filter, mux_srt_input, temp_video, progress=progress)
+        else:
+            filter_complex = build_filter_graph(speed_up, width, height, subtitle_filter if burn else None, watermark_input, bgm_input, bgm_volume, video_volume)
+            ffmpeg_command = [
+                'ffmpeg',
+                *inputs,
+                '-filter_complex', filter_complex,
+                '-map', '[v]',
+                '-map', '[a]',
+            ]
+            if srt_input is not None:
+                ffmpeg_command += ['-map', f'{srt_input}:s', '-c:s', 'mov_text']
+            ffmpeg_command += [
+                '-r', str(fps),
+                '-c:v', 'libx264',
+                '-c:a', 'aac',
+            ]
+            success = run_ffmpeg(ffmpeg_command, temp_video, cwd=folder, progress=progress, job='synthesize_video')
+        if success:
+            break
+        if os.path.exists(temp_video):
+            os.remove(temp_video)
+    else:
+        raise Exception(f'视频合成失败: {folder}')
+    os.replace(temp_video, final_video)
     return final_video
 
 
-def add_subtitles(video_path, srt_path, output_path, subtitle_filter=None, method='ffmpeg'):
+# 各分辨率的目标码率，HLS 主播放列表需要据此声明带宽
+rendition_bitrates = {
+    '4320p': '45000k',
+    '2160p': '16000k',
+    '1440p': '9000k',
+    '1080p': '5000k',
+    '720p': '2800k',
+    '480p': '1400k',
+    '360p': '800k',
+    '240p': '400k',
+    '144p': '200k',
+}
+
+def synthesize_renditions(folder, renditions=('1080p', '720p', '480p'), subtitles=True, speed_up=1.00, fps=30, background_music=None, watermark_path=None, bgm_volume=0.5, video_volume=1.0, burn_subtitles=True, hls=False, progress_callback=None):
     """
-    给视频文件添加字幕。
-
-    参数：
-        video_path (str): 输入视频文件的路径。
-        srt_path (str): .srt 字幕文件的路径。
-        output_path (str): 输出视频文件的路径。
-        subtitle_filter (str): 自定义字幕过滤器，默认为None，使用标准filter。
-        method (str): 使用的方法 ('moviepy' 或 'ffmpeg')，默认为 'ffmpeg'。
-
-    返回：
-        bool: 成功返回 True，失败返回 False。
+    一次解码输出多个分辨率：变速、水印和字幕只处理一次（按最高分辨率烧录），再 split 成多路分别缩放编码，
+    输出 video_<分辨率>.mp4。hls 为 True 时改为输出 hls/<分辨率>/ 下的分片和 hls/master.m3u8（HLS 不封装软字幕）。
+    返回最高分辨率的视频或主播放列表路径。
     """
-    try:
-        # 确保temp目录存在
-        temp_dir = "temp"
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir)
-
-        # 生成随机字符串作为临时文件名
-        random_string = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
-        temp_video_path = os.path.join(temp_dir, f"temp_video_{random_string}.mp4")
-
-        random_string = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
-        temp_srt_path = os.path.join(temp_dir, f"temp_srt_{random_string}.srt")
+    translation_path = os.path.join(folder, 'translation.json')
+    input_audio = os.path.join(folder, 'audio_combined.wav')
+    input_video = os.path.join(folder, 'download.mp4')
+    if not os.path.exists(translation_path) or not os.path.exists(input_audio):
+        return
 
-        random_string = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
-        temp_output_path = os.path.join(temp_dir, f"temp_output_{random_string}.mp4")
+    with open(translation_path, 'r', encoding='utf-8') as f:
+        translation = json.load(f)
+    srt_path = os.path.join(folder, 'subtitles.srt')
+    generate_srt(translation, srt_path, speed_up)
+    video_size = get_video_size(input_video)
+    renditions = sorted(renditions, key=lambda resolution: int(resolution[:-1]), reverse=True)
+    sizes = [convert_resolution(video_size[0] / video_size[1], resolution) for resolution in renditions]
+    width, height = sizes[0]
+    font_size = int(width/128)
+    outline = int(round(font_size/8))
 
-        # 检查源文件是否存在
-        if not os.path.exists(video_path):
-            logger.error(f"输入视频文件不存在: {video_path}")
-            return False
+    inputs = ['-i', os.path.abspath(input_video), '-i', os.path.abspath(input_audio)]
+    watermark_input, bgm_input, srt_input = None, None, None
+    if watermark_path:
+        watermark_input = len(inputs) // 2
+        inputs += ['-i', os.path.abspath(watermark_path)]
+    if background_music:
+        bgm_input = len(inputs) // 2
+        inputs += ['-i', os.path.abspath(background_music)]
+    if subtitles and not burn_subtitles and not hls:
+        srt_input = len(inputs) // 2
+        inputs += ['-i', os.path.basename(srt_path)]
+    subtitle_filter = make_subtitle_filter(os.path.basename(srt_path), font_size, outline) if subtitles and burn_subtitles else None
+
+    # 共用的滤镜输出 [v]（最高分辨率），再分成多路缩放；音频同样 asplit 成多路
+    n = len(renditions)
+    filter_complex = build_filter_graph(speed_up, width, height, subtitle_filter, watermark_input, bgm_input, bgm_volume, video_volume)
+    filter_complex += f";[v]split={n}" + ''.join(f'[s{i}]' for i in range(n))
+    filter_complex += ''.join(f";[s{i}]scale={w}:{h}[v{i}]" for i, (w, h) in enumerate(sizes))
+    filter_complex += f";[a]asplit={n}" + ''.join(f'[a{i}]' for i in range(n))
+    command = ['ffmpeg', *inputs, '-filter_complex', filter_complex]
+    progress = report_progress(progress_callback, get_duration(input_video) / speed_up)
+
+    if hls:
+        hls_folder = os.path.join(folder, 'hls')
+        for resolution in renditions:
+            os.makedirs(os.path.join(hls_folder, resolution), exist_ok=True)
+        for i in range(n):
+            command += ['-map', f'[v{i}]', '-map', f'[a{i}]']
+        options = ['-r', str(fps), '-c:v', 'libx264', '-c:a', 'aac']
+        for i, resolution in enumerate(renditions):
+            options += [f'-b:v:{i}', rendition_bitrates.get(resolution, '2000k'), f'-b:a:{i}', '128k']
+        options += [
+            '-f', 'hls',
+            '-hls_time', '6',
+            '-hls_playlist_type', 'vod',
+            '-hls_segment_filename', os.path.abspath(os.path.join(hls_folder, '%v', 'segment_%04d.ts')),
+            '-master_pl_name', 'master.m3u8',
+            '-var_stream_map', ' '.join(f'v:{i},a:{i},name:{resolution}' for i, resolution in enumerate(renditions)),
+        ]
+        if not run_ffmpeg(command, [(options, os.path.abspath(os.path.join(hls_folder, '%v', 'index.m3u8')))], cwd=folder,
+                          threads=chunk_threads * n, progress=progress, job='synthesize_hls'):
+            raise Exception(f'HLS 输出失败: {folder}')
+        # master_pl_name 相对于输出模板中 %v 所在的目录，即 hls/，其中各路播放列表写作 <分辨率>/index.m3u8
+        master_playlist = os.path.join(hls_folder, 'master.m3u8')
+        if not os.path.exists(master_playlist):
+            raise Exception(f'HLS 主播放列表没有生成: {master_playlist}')
+        return master_playlist
+
+    outputs = []
+    for i, resolution in enumerate(renditions):
+        options = ['-map', f'[v{i}]', '-map', f'[a{i}]']
+        if srt_input is not None:
+            options += ['-map', f'{srt_input}:s', '-c:s', 'mov_text']
+        options += ['-r', str(fps), '-c:v', 'libx264', '-c:a', 'aac', '-f', 'mp4']
+        outputs.append((options, os.path.abspath(os.path.join(folder, f'video_{resolution}.mp4.tmp'))))
+    if not run_ffmpeg(command, outputs, cwd=folder, progress=progress, job='synthesize_renditions'):
+        for _, path in outputs:
+            if os.path.exists(path):
+                os.remove(path)
+        raise Exception(f'多分辨率输出失败: {folder}')
+    for _, path in outputs:
+        os.replace(path, path[:-len('.tmp')])
+    return outputs[0][1][:-len('.tmp')]
+
+def file_digest(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def synthesize_preview(folder, subtitles=True, speed_up=1.00, background_music=None, bgm_volume=0.5, video_volume=1.0, preview_range=None, resolution='360p', progress_callback=None):
+    """
+    渲染低分辨率、ultrafast 预设、低码率的预览视频 video_preview.mp4，用于在正式渲染前检查配音时间轴。
+    preview_range 为输出时间轴上的 (开始, 结束) 秒数，None 表示全片。
+    配音、译文和参数都没有变化时直接返回上次的预览。
+    """
+    translation_path = os.path.join(folder, 'translation.json')
+    input_audio = os.path.join(folder, 'audio_combined.wav')
+    input_video = os.path.join(folder, 'download.mp4')
+    if not os.path.exists(translation_path) or not os.path.exists(input_audio):
+        return
 
-        if not os.path.exists(srt_path):
-            logger.error(f"字幕文件不存在: {srt_path}")
-            return False
+    preview_video = os.path.join(folder, 'video_preview.mp4')
+    cache_path = os.path.join(folder, 'video_preview.json')
+    fingerprint = {
+        'audio': file_digest(input_audio),
+        'translation': file_digest(translation_path),
+        'params': [subtitles, speed_up, background_music, bgm_volume, video_volume, preview_range, resolution],
+    }
+    if os.path.exists(preview_video) and os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            if json.load(f) == json.loads(json.dumps(fingerprint)):
+                logger.info(f'预览未变化，直接使用: {preview_video}')
+                return preview_video
 
-        # 确保输出目录存在
-        output_dir = os.path.dirname(output_path)
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
-        # 开始复制原始文件到临时文件
-        shutil.copyfile(video_path, temp_video_path)
-        shutil.copyfile(srt_path, temp_srt_path)
-
-        # 使用绝对路径避免路径问题
-        temp_video_path = os.path.abspath(temp_video_path)
-        temp_srt_path = os.path.abspath(temp_srt_path)
-        temp_output_path = os.path.abspath(temp_output_path)
-        # 开始检查确认字幕文件是否存在
-        if not os.path.exists(temp_srt_path):
-            logger.error(f"字幕文件不存在: {temp_srt_path}")
-            return False
-        # 开始检查确认视频文件是否存在
-        if not os.path.exists(temp_video_path):
-            logger.error(f"输入视频文件不存在: {temp_video_path}")
-            return False
+    with open(translation_path, 'r', encoding='utf-8') as f:
+        translation = json.load(f)
+    video_size = get_video_size(input_video)
+    width, height = convert_resolution(video_size[0] / video_size[1], resolution)
+    font_size = max(int(width/128), 8)
+    outline = max(int(round(font_size/8)), 1)
+
+    # 原视频和配音都在原始时间轴上，预览的时间范围要换算回去
+    seek = []
+    start, end = 0, None
+    if preview_range:
+        start, end = preview_range
+        seek = ['-ss', str(start * speed_up), '-t', str((end - start) * speed_up)]
+    inputs = [*seek, '-i', os.path.abspath(input_video), *seek, '-i', os.path.abspath(input_audio)]
+    bgm_input = None
+    if background_music:
+        bgm_input = 2
+        inputs += ['-i', os.path.abspath(background_music)]
+    subtitle_filter = None
+    srt_name = 'subtitles_preview.srt'
+    if subtitles:
+        generate_srt(translation, os.path.join(folder, srt_name), speed_up, offset=start, duration=None if end is None else end - start)
+        subtitle_filter = make_subtitle_filter(srt_name, font_size, outline)
+
+    duration = end - start if end is not None else get_duration(input_video) / speed_up - start
+    progress = report_progress(progress_callback, duration, label='预览渲染')
+    temp_video = os.path.abspath(preview_video + '.tmp')
+    ffmpeg_command = [
+        'ffmpeg',
+        *inputs,
+        '-filter_complex', build_filter_graph(speed_up, width, height, subtitle_filter, None, bgm_input, bgm_volume, video_volume),
+        '-map', '[v]',
+        '-map', '[a]',
+        '-c:v', 'libx264',
+        '-preset', 'ultrafast',
+        '-crf', '32',
+        '-maxrate', '600k',
+        '-bufsize', '1200k',
+        '-c:a', 'aac',
+        '-b:a', '64k',
+    ]
+    try:
+        if not run_ffmpeg(ffmpeg_command, temp_video, cwd=folder, progress=progress, job='synthesize_preview'):
+            raise Exception(f'预览渲染失败: {folder}')
+    finally:
+        if os.path.exists(os.path.join(folder, srt_name)):
+            os.remove(os.path.join(folder, srt_name))
+    os.replace(temp_video, preview_video)
+    with open(cache_path, 'w', encoding='utf-8') as f:
+        json.dump(fingerprint, f, indent=2, ensure_ascii=False)
+    return preview_video
 
-        if method == 'moviepy':
-            from moviepy import VideoFileClip, TextClip, CompositeVideoClip
-            from moviepy.video.tools.subtitles import SubtitlesClip
-
-            # 使用 moviepy 添加字幕
-            video = VideoFileClip(temp_video_path)
-            generator = lambda txt: TextClip(txt, font='font/SimHei.ttf', fontsize=24, color='white')
-            subtitles = SubtitlesClip(temp_srt_path, generator)
-            final_video = video.copy()
-
-            final_video = final_video.set_subtitles(subtitles)
-            # 保存视频
-            final_video.write_videofile(temp_output_path, fps=video.fps)
-
-            # 复制回原始位置
-            if os.path.exists(temp_output_path):
-                shutil.copyfile(temp_output_path, output_path)
-                logger.info(f"字幕添加成功，输出到: {output_path}")
-                return True
-            else:
-                logger.error(f"输出文件未生成: {temp_output_path}")
-                return False
-
-        elif method == 'ffmpeg':
-            # 使用 ffmpeg 添加字幕
-            try:
-                # 获取字体文件的绝对路径
-                font_dir = os.path.abspath("./font")
-
-                # 构建字幕过滤器，使用文件名引用
-                style = "FontName=SimHei,FontSize=15,PrimaryColour=&HFFFFFF,OutlineColour=&H000000,Outline=2,WrapStyle=2"
-                filter_option = f"subtitles={temp_srt_path}:force_style='{style}'"
-
-                # 构建命令
-                command = [
-                    'ffmpeg',
-                    '-i', f"{temp_video_path}",
-                    '-vf', f"{filter_option}",
-                    '-c:a', 'copy',
-                    f"{temp_output_path}",
-                    '-y',
-                    '-threads', '2',
-                ]
-
-                logger.info(f"执行FFmpeg命令: {' '.join(command)}")
-
-                # 执行命令
-                result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                stderr_output = result.stderr.decode('utf-8', errors='ignore')
-                logger.debug(f"FFmpeg输出: {stderr_output}")
-
-                # 检查是否成功生成输出文件
-                if os.path.exists(temp_output_path):
-                    # 确保输出目录存在
-                    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-                    shutil.copyfile(temp_output_path, output_path)
-                    logger.info(f"字幕添加成功，输出到: {output_path}")
-                    return True
-                else:
-                    logger.error(f"FFmpeg执行成功但输出文件未生成: {temp_output_path}")
-                    return False
-
-            except subprocess.CalledProcessError as e:
-                logger.error(f"FFmpeg命令执行失败: {e}")
-                stderr_output = e.stderr.decode('utf-8', errors='ignore') if e.stderr else "No stderr output"
-                logger.error(f"FFmpeg错误输出: {stderr_output}")
-                return False
-
-            except Exception as e:
-                logger.error(f"添加字幕时发生错误: {str(e)}")
-                import traceback
-                logger.error(f"错误堆栈: {traceback.format_exc()}")
-                return False
-        else:
-            logger.error(f"不支持的方法: {method}. 请使用 'moviepy' 或 'ffmpeg'")
-            return False
 
-    except Exception as e:
-        logger.error(f"添加字幕时发生错误: {str(e)}")
-        import traceback
-        logger.debug(f"错误详情: {traceback.format_exc()}")
-        return False
-    finally:
-        # 清理临时文件
-        temp_files = [temp_video_path, temp_srt_path, temp_output_path]
-        if method == 'ffmpeg':
-            temp_files.append(os.path.join(temp_dir, "subtitles.srt"))
-
-        for temp_file in temp_files:
-            if temp_file and os.path.exists(temp_file):
-                try:
-                    os.remove(temp_file)
-                except Exception as e:
-                    logger.debug(f"无法删除临时文件 {temp_file}: {e}")
-
-def synthesize_all_video_under_folder(folder, subtitles=True, speed_up=1.00, fps=30, background_music=None, bgm_volume=0.5, video_volume=1.0, resolution='1080p', watermark_path="f_logo.png"):
+def synthesize_all_video_under_folder(folder, subtitles=True, speed_up=1.00, fps=30, background_music=None, bgm_volume=0.5, video_volume=1.0, resolution='1080p', watermark_path="f_logo.png", burn_subtitles=True, preview=False, preview_range=None, renditions=None, hls=False, progress_callback=None):
     watermark_path = None if not os.path.exists(watermark_path) else watermark_path
     output_video = None
     for root, dirs, files in os.walk(folder):
-        if 'download.mp4' in files:
+        if 'download.mp4' in files and preview:
+            output_video = synthesize_preview(root, subtitles=subtitles, speed_up=speed_up,
+                            background_music=background_music, bgm_volume=bgm_volume, video_volume=video_volume,
+                            preview_range=preview_range, progress_callback=progress_callback)
+        elif 'download.mp4' in files and (renditions or hls):
+            output_video = synthesize_renditions(root, renditions=renditions or [resolution], subtitles=subtitles,
+                            speed_up=speed_up, fps=fps, background_music=background_music,
+                            watermark_path=watermark_path, bgm_volume=bgm_volume, video_volume=video_volume,
+                            burn_subtitles=burn_subtitles, hls=hls, progress_callback=progress_callback)
+        elif 'download.mp4' in files:
             output_video = synthesize_video(root, subtitles=subtitles,
                             speed_up=speed_up, fps=fps, resolution=resolution,
                             background_music=background_music,
-                            watermark_path=watermark_path, bgm_volume=bgm_volume, video_volume=video_volume)
+                            watermark_path=watermark_path, bgm_volume=bgm_volume, video_volume=video_volume,
+                            burn_subtitles=burn_subtitles, progress_callback=progress_callback)
         # if 'download.mp4' in files and 'video.mp4' not in files:
         #     output_video = synthesize_video(root, subtitles=subtitles,
         #                      speed_up=speed_up, fps=fps, resolution=resolution,
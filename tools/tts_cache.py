@@ -0,0 +1,101 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+from loguru import logger
+
+# 跨视频共享的 TTS 片段缓存，以文本、引擎、语言、音色和合成参数的哈希作为文件名
+cache_dir = os.getenv('TTS_CACHE_DIR', 'models/TTS/cache')
+max_cache_mb = float(os.getenv('TTS_CACHE_MAX_MB', 2048))
+
+cache_lock = threading.Lock()
+cache_size = None
+file_hashes = {}
+
+def normalize_text(text):
+    return ' '.join(text.split())
+
+def file_hash(path):
+    """参考音频的内容哈希，按路径和修改时间缓存"""
+    mtime = os.path.getmtime(path)
+    cached = file_hashes.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    file_hashes[path] = (mtime, sha256.hexdigest())
+    return file_hashes[path][1]
+
+def clip_key(text, method, target_language, voice=None, speaker_wav=None, settings=None):
+    payload = {
+        'text': normalize_text(text),
+        'method': method,
+        'language': target_language,
+        'voice': voice,
+        'speaker': file_hash(speaker_wav) if speaker_wav else None,
+        'settings': settings or {},
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def clip_path(key):
+    return os.path.join(cache_dir, key[:2], f'{key}.wav')
+
+def fetch(key, output_path):
+    """命中时把缓存片段复制到 output_path 并刷新访问时间"""
+    path = clip_path(key)
+    if not os.path.exists(path):
+        return False
+    try:
+        shutil.copyfile(path, output_path)
+        os.utime(path)
+    except OSError as e:
+        logger.warning(f'读取 TTS 缓存失败: {e}')
+        return False
+    return True
+
+def store(key, wav_path):
+    global cache_size
+    path = clip_path(key)
+    if os.path.exists(path):
+        os.utime(path)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    shutil.copyfile(wav_path, tmp_path)
+    os.replace(tmp_path, path)
+    with cache_lock:
+        if cache_size is None:
+            cache_size = sum(size for _, size, _ in list_clips())
+        else:
+            cache_size += os.path.getsize(path)
+        if cache_size > max_cache_mb * 1024 * 1024:
+            evict()
+
+def list_clips():
+    for root, dirs, files in os.walk(cache_dir):
+        for file in files:
+            if file.endswith('.wav'):
+                path = os.path.join(root, file)
+                stat = os.stat(path)
+                yield path, stat.st_size, stat.st_mtime
+
+def evict():
+    """按最近访问时间淘汰，直到缓存降到上限的 90% 以下"""
+    global cache_size
+    clips = sorted(list_clips(), key=lambda clip: clip[2])
+    cache_size = sum(size for _, size, _ in clips)
+    limit = max_cache_mb * 1024 * 1024 * 0.9
+    removed = 0
+    for path, size, _ in clips:
+        if cache_size <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        cache_size -= size
+        removed += 1
+    logger.info(f'TTS 缓存淘汰 {removed} 个片段，当前 {cache_size / 1024 / 1024:.1f}MB')
@@ -1,5 +1,12 @@
+import os
 import re
+import json
+import time
 import string
+import threading
+import subprocess
+from collections import deque
+from contextlib import contextmanager
 import numpy as np
 from scipy.io import wavfile
 
@@ -30,6 +37,144 @@ def normalize_wav(wav_path: str) -> None:
     wav_norm = wav * (32767 / max(0.01, np.max(np.abs(wav))))
     wavfile.write(wav_path, sample_rate, wav_norm.astype(np.int16))
 
+def time_stretch(wav: np.ndarray, ratio: float, sample_rate=24000, frame_ms=40, tolerance_ms=10) -> np.ndarray:
+    """
+    WSOLA 时间伸缩（不改变音高），ratio 为输出时长与输入时长之比。
+    每一帧在名义位置附近 tolerance_ms 内搜索与上一帧自然延续最相似的片段，再用汉宁窗重叠相加。
+    """
+    wav = np.asarray(wav, dtype=np.float32)
+    out_len = int(round(len(wav) * ratio))
+    if abs(ratio - 1) < 1e-3 or len(wav) == 0:
+        return wav[:out_len].copy()
+    frame = int(sample_rate * frame_ms / 1000)
+    hop = frame // 2
+    tolerance = int(sample_rate * tolerance_ms / 1000)
+    window = np.hanning(frame).astype(np.float32)
+    num_frames = max(1, int(np.ceil(max(out_len - frame, 0) / hop)) + 1)
+    padded = np.pad(wav, (tolerance, frame + tolerance + hop))
+    output = np.zeros(num_frames * hop + frame, dtype=np.float32)
+    norm = np.zeros_like(output)
+    prev = tolerance
+    for k in range(num_frames):
+        center = min(int(k * hop / ratio), len(wav)) + tolerance
+        if k == 0:
+            pos = center
+        else:
+            target = padded[prev + hop: prev + hop + frame]
+            region = padded[center - tolerance: center + tolerance + frame]
+            candidates = np.lib.stride_tricks.sliding_window_view(region, frame)
+            pos = center - tolerance + int(np.argmax(candidates @ target))
+        output[k * hop: k * hop + frame] += padded[pos: pos + frame] * window
+        norm[k * hop: k * hop + frame] += window
+        prev = pos
+    output /= np.maximum(norm, 1e-3)
+    return output[:out_len]
+
+class CoreBudget:
+    """
+    进程内共享的 CPU 核心预算。多个视频同时编码时，每个 ffmpeg 进程先申请自己要用的核心数，
+    不够时排队等待，避免同一台机器被超额占用。
+    """
+    def __init__(self, total):
+        self.total = max(1, total)
+        self.available = self.total
+        self.condition = threading.Condition()
+
+    def acquire(self, cores):
+        cores = max(1, min(cores, self.total))
+        with self.condition:
+            self.condition.wait_for(lambda: self.available >= cores)
+            self.available -= cores
+        return cores
+
+    def release(self, cores):
+        with self.condition:
+            self.available += cores
+            self.condition.notify_all()
+
+    @contextmanager
+    def reserve(self, cores):
+        cores = self.acquire(cores)
+        try:
+            yield cores
+        finally:
+            self.release(cores)
+
+core_budget = CoreBudget(int(os.getenv('FFMPEG_CORE_BUDGET', os.cpu_count() or 1)))
+
+# 每个 ffmpeg 任务结束后的吞吐量记录（每行一个 JSON），用于容量规划
+ffmpeg_stats_path = os.getenv('FFMPEG_STATS_PATH', 'logs/ffmpeg_stats.jsonl')
+
+def get_duration(media_path):
+    command = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'json', media_path]
+    result = subprocess.run(command, capture_output=True, text=True)
+    return float(json.loads(result.stdout)['format']['duration'])
+
+def find_media_source(folder):
+    """视频目录下可用于提取音频的源文件：优先 download.mp4，否则为先行下载的音轨 download_audio.*"""
+    video_path = os.path.join(folder, 'download.mp4')
+    if os.path.exists(video_path):
+        return video_path
+    if not os.path.isdir(folder):
+        return None
+    for file in sorted(os.listdir(folder)):
+        if file.startswith('download_audio.') and not file.endswith(('.part', '.ytdl', '.json')):
+            return os.path.join(folder, file)
+    return None
+
+def run_ffmpeg_progress(command, progress_callback=None, cwd=None, job='ffmpeg'):
+    """
+    运行 ffmpeg 并解析 -progress pipe:1 的输出，每次进度更新调用 progress_callback(out_time, fps, speed)，
+    out_time 为已输出的秒数，speed 为相对实时的倍数。结束后把本次任务的吞吐量追加到 ffmpeg_stats_path。
+    返回 (是否成功, stderr 末尾若干行)。
+    """
+    command = [command[0], '-progress', 'pipe:1', '-nostats', *command[1:]]
+    t_start = time.time()
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               text=True, encoding='utf-8', errors='ignore')
+    # stderr 在单独的线程里读完，避免管道写满后 ffmpeg 阻塞
+    stderr_tail = deque(maxlen=50)
+    reader = threading.Thread(target=stderr_tail.extend, args=(process.stderr, ), daemon=True)
+    reader.start()
+    out_time, fps, speed, frames = 0.0, 0.0, 0.0, 0
+    for line in process.stdout:
+        key, _, value = line.strip().partition('=')
+        try:
+            # out_time_ms 的单位其实也是微秒
+            if key in ('out_time_us', 'out_time_ms'):
+                out_time = int(value) / 1e6
+            elif key == 'fps':
+                fps = float(value)
+            elif key == 'frame':
+                frames = int(value)
+            elif key == 'speed':
+                speed = float(value.rstrip('x'))
+        except ValueError:
+            continue
+        if key == 'progress' and progress_callback:
+            progress_callback(out_time, fps, speed)
+    process.wait()
+    reader.join()
+
+    elapsed = time.time() - t_start
+    stats = {
+        'job': job,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'success': process.returncode == 0,
+        'media_seconds': round(out_time, 3),
+        'elapsed_seconds': round(elapsed, 3),
+        'frames': frames,
+        'fps': round(frames / elapsed, 2) if elapsed > 0 else 0,
+        'speed': round(out_time / elapsed, 3) if elapsed > 0 else 0,
+    }
+    try:
+        os.makedirs(os.path.dirname(ffmpeg_stats_path) or '.', exist_ok=True)
+        with open(ffmpeg_stats_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(stats, ensure_ascii=False) + '\n')
+    except OSError:
+        pass
+    return process.returncode == 0, ''.join(stderr_tail)
+
 SUPPORT_VOICE = ['zu-ZA-ThembaNeural', 'zu-ZA-ThandoNeural',  'zh-TW-YunJheNeural', 'zh-TW-HsiaoYuNeural', 'zh-TW-HsiaoChenNeural', 'zh-HK-WanLungNeural', 
     'zh-HK-HiuMaanNeural', 'zh-HK-HiuGaaiNeural', 'zh-CN-shaanxi-XiaoniNeural', 'zh-CN-liaoning-XiaobeiNeural', 
     'zh-CN-YunyangNeural', 'zh-CN-YunxiaNeural', 'zh-CN-YunxiNeural', 'zh-CN-YunjianNeural', 